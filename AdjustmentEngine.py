@@ -0,0 +1,173 @@
+""" AdjustmentEngine.py: NumPy implementation of the adjustment slider chain.
+
+The source image is converted once into a BGRA uint8 working buffer (the byte order
+of QImage.Format_ARGB32 on little-endian machines) and every enabled stage runs on
+that buffer, in the same order as the sliders are laid out in the Adjust window.
+
+Each stage reproduces the PIL operation the editor used before:
+
+    Stage           PIL reference                                   Tolerance
+    Red/Green/Blue  channel.point(lambda i: i * factor)             exact
+    Saturation      ImageEnhance.Color                              exact
+    Brightness      ImageEnhance.Brightness                         exact
+    Contrast        ImageEnhance.Contrast                           exact
+    Sharpness       ImageEnhance.Sharpness                          exact
+    Gaussian Blur   ImageFilter.GaussianBlur                        see BlurEngine
+
+"Exact" holds for the rounding of the installed Pillow; older Pillow releases truncate
+instead of round in Image.point and the kernel filters, which moves single pixels by
+one level. The blur is exact at blur quality EXACT and within a level or two of PIL
+otherwise.
+"""
+
+import functools
+
+import numpy as np
+import cv2
+
+from BlurEngine import BALANCED, gaussianBlur
+from TileScheduler import defaultScheduler
+from ScratchDisk import defaultScratchDisk
+from PointOpCompiler import ALPHA, BLUE, GREEN, IDENTITY_TABLE, RED, PointOp, blendTable, channelTable, compileStages, composeTables, inPlace, luma, runPasses
+from StageCache import StageCache
+
+# Slider state of an untouched image, keyed like the Gui attributes
+IDENTITY_STATE = {
+    "RedFactor": 100,
+    "GreenFactor": 100,
+    "BlueFactor": 100,
+    "Color": 100,
+    "Brightness": 100,
+    "Contrast": 100,
+    "Sharpness": 100,
+    "GaussianBlurRadius": 0,
+}
+
+# ImageFilter.SMOOTH, used by ImageEnhance.Sharpness as its degenerate image
+SMOOTH_KERNEL = np.array([[1, 1, 1],
+                          [1, 5, 1],
+                          [1, 1, 1]], dtype=np.float32) / 13
+
+
+def blend(degenerate, image, factor, out):
+    """ Writes Image.blend(degenerate, image, factor) into out.
+    PIL interpolates in single precision and truncates the clipped result. """
+    result = image.astype(np.float32)
+    result -= degenerate
+    result *= np.float32(factor)
+    result += degenerate
+    np.clip(result, 0, 255, out=result)
+    np.copyto(out, result, casting='unsafe')
+    return out
+
+
+@inPlace
+def enhanceColor(buffer, factor):
+    """ ImageEnhance.Color: blend with the greyscale image, in place """
+    def colorTile(tile):
+        degenerate = luma(tile)[..., np.newaxis]
+        rgb = tile[..., :ALPHA]
+        blend(degenerate, rgb, factor, rgb)
+        return tile
+    return defaultScheduler.map(colorTile, buffer, out=buffer)
+
+
+def sharpenTile(tile, factor):
+    """ Blends a tile with its ImageFilter.SMOOTH image into a new tile """
+    rgb = tile[..., :ALPHA]
+    smooth = cv2.filter2D(rgb.astype(np.float32), -1, SMOOTH_KERNEL, borderType=cv2.BORDER_REPLICATE)
+    np.round(smooth, out=smooth)
+    out = defaultScratchDisk.copy(tile)
+    blend(smooth, rgb, factor, out[..., :ALPHA])
+    return out
+
+
+def enhanceSharpness(buffer, factor):
+    """ ImageEnhance.Sharpness: blend with the ImageFilter.SMOOTH image """
+    out = defaultScheduler.map(functools.partial(sharpenTile, factor=factor), buffer, halo=1)
+
+    # PIL leaves the one pixel border of the smoothed image unfiltered, so the blend keeps it
+    out[0, :] = buffer[0, :]
+    out[-1, :] = buffer[-1, :]
+    out[:, 0] = buffer[:, 0]
+    out[:, -1] = buffer[:, -1]
+    return out
+
+
+class AdjustmentEngine:
+
+    """ Renders a slider state onto a BGRA working buffer.
+    The slider state is a dict keyed like IDENTITY_STATE, with the raw slider values. """
+
+    def __init__(self, blurQuality=BALANCED):
+        # BlurEngine quality of the Gaussian Blur stage
+        self.blurQuality = blurQuality
+
+        # Outputs of the passes of recent renders, see render()
+        self.stageCache = StageCache()
+
+    def isIdentity(self, state):
+        """ Returns True if no stage is enabled for the given slider state """
+        return all(state[key] == value for key, value in IDENTITY_STATE.items())
+
+    def stages(self, state, scale=1.0, sourceMean=None):
+        """ Returns the enabled stages in slider order, for a buffer scale times the image size.
+        Point operations are PointOps, the rest are callables taking and returning a buffer.
+        sourceMean, if given, returns the mean grey level of the unscaled source image; contrast
+        then needs no pass of its own when it is the first stage. """
+        stages = []
+        if state["RedFactor"] != 100:
+            stages.append(PointOp(channelTable(RED, state["RedFactor"] / 100)))
+        if state["GreenFactor"] != 100:
+            stages.append(PointOp(channelTable(GREEN, state["GreenFactor"] / 100)))
+        if state["BlueFactor"] != 100:
+            stages.append(PointOp(channelTable(BLUE, state["BlueFactor"] / 100)))
+        if state["Color"] != 100:
+            stages.append(functools.partial(enhanceColor, factor=state["Color"] / 100))
+        if state["Brightness"] != 100:
+            # ImageEnhance.Brightness: blend with black
+            stages.append(PointOp(blendTable(0, state["Brightness"] / 100)))
+        if state["Contrast"] != 100:
+            # ImageEnhance.Contrast: blend with a solid image of the mean grey level
+            if sourceMean is not None and not stages:
+                stages.append(PointOp(blendTable(sourceMean(), state["Contrast"] / 100)))
+            else:
+                stages.append(PointOp(tableForMean=functools.partial(blendTable, factor=state["Contrast"] / 100)))
+        if state["Sharpness"] != 100:
+            stages.append(functools.partial(enhanceSharpness, factor=state["Sharpness"] / 100))
+        if state["GaussianBlurRadius"] > 0:
+            # The radius is in image pixels, a proxy is blurred proportionally less
+            radius = state["GaussianBlurRadius"] / 100 * scale
+            stages.append(functools.partial(gaussianBlur, radius=radius, quality=self.blurQuality))
+        return stages
+
+    def pointTable(self, state, sourceMean=None):
+        """ Returns the (4, 256) table the whole chain amounts to if every enabled stage is a
+        point operation with a fixed table, else None. Contrast depends on the image mean,
+        which is only known up front as the first stage and with sourceMean. """
+        table = IDENTITY_TABLE
+        for stage in self.stages(state, sourceMean=sourceMean):
+            if not isinstance(stage, PointOp) or not stage.isFixed():
+                return None
+            table = composeTables(table, stage.table(None, table))
+        return table
+
+    def render(self, buffer, state, isCancelled=None, scale=1.0, key=None, sourceMean=None):
+        """ Runs every enabled stage on buffer, in place where the stage allows it.
+        scale is the size of buffer relative to the image, for renders of a proxy.
+        Consecutive point operations are folded into a single lookup table pass.
+        Returns the result, which is buffer itself unless the sharpness or blur stage ran,
+        or None if isCancelled() turned True between two stages.
+
+        With a key identifying the contents of buffer, the output of every pass is cached
+        and a render resumes after the last pass whose parameters did not change since.
+        buffer is not written to then, and the result is read-only.
+
+        sourceMean is passed on to stages(), proxies take the mean of the full image.
+        The identity state returns buffer as it is, without a pass or a cache entry. """
+        if self.isIdentity(state):
+            return buffer
+        passes = compileStages(self.stages(state, scale, sourceMean))
+        if key is None:
+            return runPasses(passes, buffer, isCancelled)
+        return runPasses(passes, buffer, isCancelled, self.stageCache, key)
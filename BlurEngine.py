@@ -0,0 +1,165 @@
+""" BlurEngine.py: Gaussian blur whose cost does not grow with the radius.
+
+PIL approximates a Gaussian by three passes of an extended box filter: a box of
+fractional width whose two outermost taps carry the fractional weight. Box filters are
+computed from running sums, so a pass costs the same for every radius. boxBlur
+reproduces PIL's fixed point arithmetic and matches ImageFilter.GaussianBlur exactly.
+
+The approximate qualities skip the rounding PIL does after every pass and convolve
+with the combined kernel of the passes in one go, which is several times faster than
+PIL. Large radii are blurred on a downscaled copy. The image is reduced by a power of
+two so that the remaining blur stays above minimumSigma pixels, blurred there and
+scaled back up; the blur added by the reduction and the enlargement is taken out of
+the radius. The quality setting picks minimumSigma:
+
+    Quality     Method                                      Tolerance
+    exact       box passes at full resolution               exact
+    balanced    one kernel, downscaled from radius 6 on     mean < 1 level
+    fast        one kernel, downscaled from radius 4 on     mean < 1 level
+
+The approximations keep photographs within a few levels of PIL; on pixel noise single
+pixels can be off by more. test_BlurEngine.py checks the tolerances against Pillow.
+"""
+
+import math
+
+import numpy as np
+import cv2
+
+from ScratchDisk import defaultScratchDisk
+from TileScheduler import defaultScheduler
+
+EXACT = "exact"
+BALANCED = "balanced"
+FAST = "fast"
+
+# Smallest standard deviation left to blur on a downscaled copy, None never downscales
+MINIMUM_SIGMA = {
+    EXACT: None,
+    BALANCED: 3.0,
+    FAST: 2.0,
+}
+
+# Box passes per axis, like ImageFilter.GaussianBlur
+PASSES = 3
+
+
+def boxRadius(radius, passes=PASSES):
+    """ Fractional box radius whose passes have the variance of a Gaussian of the given
+    standard deviation, computed in single precision like PIL (Gwosdek et al. 2011) """
+    f = np.float32
+    sigma2 = f(f(radius) * f(radius) / passes)
+    L = f(math.sqrt(12.0 * float(sigma2) + 1.0))
+    l = f(math.floor((float(L) - 1.0) / 2.0))
+    a = f((2 * l + 1) * (l * (l + 1) - 3 * sigma2))
+    a = f(a / (6 * (sigma2 - (l + 1) * (l + 1))))
+    return f(l + a)
+
+
+def boxWeights(radius):
+    """ Integer radius of the box, and PIL's 24 bit fixed point weights of the taps
+    inside it and of the two fractional taps just outside it """
+    r = int(radius)
+    ww = int(np.float32(1 << 24) / (np.float32(radius) * 2 + 1))
+    fw = ((1 << 24) - (r * 2 + 1) * ww) // 2
+    return r, ww, fw
+
+
+def boxPass(buffer, radius, axis):
+    """ One extended box pass along axis (1 for rows, 0 for columns), edges extended.
+    PIL weighs the box in 24 bit fixed point and rounds half up. """
+    r, ww, fw = boxWeights(radius)
+
+    inner = (2 * r + 1, 1) if axis == 1 else (1, 2 * r + 1)
+    # Sums of up to 2 * r + 1 values fit 16 bits for every radius the sliders reach
+    depth = cv2.CV_16U if (2 * r + 1) * 255 < 1 << 16 else cv2.CV_32S
+    innerSum = cv2.boxFilter(buffer, depth, inner, normalize=False, borderType=cv2.BORDER_REPLICATE)
+
+    # The two taps just outside the box, read from a copy extended by one more pixel
+    if axis == 1:
+        extended = cv2.copyMakeBorder(buffer, 0, 0, r + 1, r + 1, cv2.BORDER_REPLICATE)
+        width = buffer.shape[1]
+        taps = cv2.add(extended[:, :width], extended[:, 2 * r + 2:], dtype=depth)
+    else:
+        extended = cv2.copyMakeBorder(buffer, r + 1, r + 1, 0, 0, cv2.BORDER_REPLICATE)
+        height = buffer.shape[0]
+        taps = cv2.add(extended[:height], extended[2 * r + 2:], dtype=depth)
+
+    # ww on the box, fw on the taps. Scaled by 2^-24 every product is exact in double
+    # precision; the 2^-26 offset turns OpenCV's round half to even into PIL's round
+    # half up, since results are multiples of 2^-24.
+    return cv2.addWeighted(innerSum, ww / (1 << 24), taps, fw / (1 << 24), 2.0 ** -26, dtype=cv2.CV_8U)
+
+
+def boxKernel(radius):
+    """ Weights of PASSES extended box passes of the given box radius, as one kernel """
+    r, ww, fw = boxWeights(radius)
+    box = np.array([fw] + [ww] * (2 * r + 1) + [fw], dtype=np.float64) / (1 << 24)
+
+    kernel = box
+    for _ in range(PASSES - 1):
+        kernel = np.convolve(kernel, box)
+    return kernel.astype(np.float32)
+
+
+def boxBlur(buffer, radius):
+    """ ImageFilter.GaussianBlur of all four channels, computed exactly, into a new buffer """
+    radius = boxRadius(radius)
+    if radius <= 0:
+        return defaultScratchDisk.copy(buffer)
+
+    def blurTile(tile):
+        for axis in (1, 0):
+            for _ in range(PASSES):
+                tile = boxPass(tile, radius, axis)
+        return tile
+
+    # Each pass reads one pixel beyond its box
+    halo = PASSES * (int(radius) + 2)
+    return defaultScheduler.map(blurTile, buffer, halo=halo)
+
+
+def kernelBlur(buffer, radius):
+    """ ImageFilter.GaussianBlur of all four channels into a new buffer, as one separable
+    convolution with the kernel of PIL's box passes. Only the rounding PIL does after
+    every pass is missing. """
+    radius = boxRadius(radius)
+    if radius <= 0:
+        return defaultScratchDisk.copy(buffer)
+
+    kernel = boxKernel(radius)
+
+    def blurTile(tile):
+        return cv2.sepFilter2D(tile, -1, kernel, kernel, borderType=cv2.BORDER_REPLICATE)
+
+    return defaultScheduler.map(blurTile, buffer, halo=len(kernel) // 2)
+
+
+def pyramidScale(radius, quality):
+    """ Power of two to downscale by before blurring with the given radius, 1 for none """
+    minimumSigma = MINIMUM_SIGMA[quality]
+    if minimumSigma is None or radius <= minimumSigma:
+        return 1
+    return 2 ** int(math.log2(radius / minimumSigma))
+
+
+def gaussianBlur(buffer, radius, quality=BALANCED):
+    """ ImageFilter.GaussianBlur of all four channels into a new buffer.
+    quality is EXACT, BALANCED or FAST, see the module docstring. """
+    if MINIMUM_SIGMA[quality] is None:
+        return boxBlur(buffer, radius)
+
+    scale = pyramidScale(radius, quality)
+    if scale == 1:
+        return kernelBlur(buffer, radius)
+
+    height, width = buffer.shape[:2]
+    small = cv2.resize(buffer, (max(1, -(-width // scale)), max(1, -(-height // scale))), interpolation=cv2.INTER_AREA)
+
+    # Averaging scale pixels adds a variance of (scale^2 - 1) / 12, linear interpolation
+    # back up about scale^2 / 6
+    variance = radius * radius - (scale * scale - 1) / 12 - scale * scale / 6
+    small = kernelBlur(small, math.sqrt(max(variance, 0)) / scale)
+    out = defaultScratchDisk.allocate(buffer.shape)
+    return cv2.resize(small, (width, height), dst=out, interpolation=cv2.INTER_LINEAR)
+
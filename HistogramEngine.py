@@ -0,0 +1,114 @@
+""" HistogramEngine.py: R, G, B and luma histograms of a BGRA buffer in one pass.
+
+The four channels of every tile are offset into one 1024 bin range and counted with a
+single np.bincount, tiles run in parallel on the shared TileScheduler. Luma is the
+ITU-R 601-2 luma of every pixel as PIL's convert("L") computes it.
+
+Histograms can be weighted by an alpha mask (a SelectionMask, the alpha channel), each
+pixel then counts alpha / 255.
+
+Point operations need no pass over the image at all: a RemapSource derives the
+histograms of the result from the exact histograms of the source, which its ImageStats
+keeps, and the lookup table.
+
+The exact mode counts every pixel. The sampled mode, meant for interactive updates,
+counts a regular grid of at most samplePixels pixels and scales the counts up to the
+size of the buffer, so both modes plot on the same scale.
+"""
+
+import math
+
+import numpy as np
+
+from PointOpCompiler import BLUE, GREEN, RED, luma
+from TileScheduler import defaultScheduler
+
+# Rows of the (4, 256) histogram array
+RED_HISTOGRAM = 0
+GREEN_HISTOGRAM = 1
+BLUE_HISTOGRAM = 2
+LUMA_HISTOGRAM = 3
+
+# Bin offset of each row in the combined count
+OFFSETS = np.arange(4, dtype=np.uint16)[:, np.newaxis, np.newaxis] * 256
+
+
+def countTile(tile, alpha=None):
+    """ Counts one tile into a (4, 256) array """
+    planes = np.empty((4,) + tile.shape[:2], dtype=np.uint16)
+    planes[RED_HISTOGRAM] = tile[..., RED]
+    planes[GREEN_HISTOGRAM] = tile[..., GREEN]
+    planes[BLUE_HISTOGRAM] = tile[..., BLUE]
+    planes[LUMA_HISTOGRAM] = luma(tile)
+    planes += OFFSETS
+
+    weights = None
+    if alpha is not None:
+        weights = np.broadcast_to(alpha / 255.0, planes.shape).ravel()
+    return np.bincount(planes.ravel(), weights=weights, minlength=1024).reshape(4, 256)
+
+
+class RemapSource:
+
+    """ What remap() needs of the source of point operations: its histograms, and a sparse
+    sample of its pixels since luma depends on all three channels of a pixel at once """
+
+    def __init__(self, histograms, sample):
+        self.histograms = histograms
+        self.sample = sample
+
+    def remap(self, table):
+        """ Histograms of the source mapped through a (4, 256) point operation table.
+        R, G and B are remapped bin by bin, exact if the source histograms are. Luma is
+        counted on the sample mapped through the table and scaled to the pixel count, no
+        image pixel is looked at. """
+        remapped = np.empty_like(self.histograms)
+        for row, channel in ((RED_HISTOGRAM, RED), (GREEN_HISTOGRAM, GREEN), (BLUE_HISTOGRAM, BLUE)):
+            remapped[row] = np.bincount(table[channel], weights=self.histograms[row], minlength=256)
+        counts = np.bincount(luma(self.sample, table).ravel(), minlength=256)
+        remapped[LUMA_HISTOGRAM] = counts * (self.histograms[LUMA_HISTOGRAM].sum() / max(counts.sum(), 1))
+        return remapped
+
+
+class HistogramEngine:
+
+    def __init__(self, samplePixels=512 * 512, remapPixels=256 * 256):
+        # Pixels counted at most in the sampled mode
+        self.samplePixels = samplePixels
+
+        # Pixels kept at most by a RemapSource
+        self.remapPixels = remapPixels
+
+    def sampleStep(self, buffer, samplePixels=None):
+        """ Grid step of the sampled mode, 1 if the buffer is small enough to count in full """
+        pixels = buffer.shape[0] * buffer.shape[1]
+        return max(1, int(math.ceil(math.sqrt(pixels / (samplePixels or self.samplePixels)))))
+
+    def histograms(self, buffer, alpha=None, exact=True):
+        """ Returns the (4, 256) R, G, B and luma histograms of a BGRA buffer as floats.
+        alpha is an optional (height, width) uint8 weight of every pixel. """
+        step = 1 if exact else self.sampleStep(buffer)
+        if step > 1:
+            sampled = buffer[::step, ::step]
+            scale = buffer.shape[0] * buffer.shape[1] / (sampled.shape[0] * sampled.shape[1])
+            counts = self.histograms(sampled, None if alpha is None else alpha[::step, ::step])
+            counts *= scale
+            return counts
+
+        if alpha is None:
+            counts = defaultScheduler.reduce(countTile, buffer)
+        else:
+            counts = defaultScheduler.reduce(countTile, buffer, alpha)
+        return np.sum(counts, axis=0, dtype=np.float64)
+
+    def selectionHistograms(self, buffer, mask, exact=True):
+        """ Histograms of the pixels of buffer inside a SelectionMask, or of all of them if mask is None """
+        if mask is None:
+            return self.histograms(buffer, exact=exact)
+        return self.histograms(mask.crop(buffer), mask.alpha, exact)
+
+    def remapSource(self, buffer, histograms):
+        """ RemapSource of buffer, whose histograms are known already (see ImageStats).
+        Only the sparse luma sample is read from buffer. """
+        step = self.sampleStep(buffer, self.remapPixels)
+        return RemapSource(histograms, np.ascontiguousarray(buffer[::step, ::step]))
@@ -0,0 +1,297 @@
+""" HistoryStore.py: Keeps the pixels of the layer history within a memory budget.
+
+Every history entry holds a HistoryImage. Images are cut into tiles of TILE_SIZE pixels
+squared, and every tile is identified by the SHA-256 hash of its pixels:
+
+    - An image with the same pixels as one stored already, a slider moved back to an
+      earlier value for instance, is not stored again; the entries share it.
+    - The images in use stay QPixmaps: the current one and, as a rule, the one it was
+      edited from. Every other image is split into tiles that are shared by reference
+      with the other stored images, without compression. Splitting an image only copies
+      the tiles no stored image has yet, the tiles its edit changed, so an entry costs
+      what its edit touched once it is no longer in use.
+    - Once all images take more than the budget, the tiles of the least recently used
+      ones are compressed with zlib. A shared tile is compressed once for all images that
+      have it.
+    - An image is put together again when it is used, typically when undo reaches it. It
+      starts from the QPixmap sharing the most tiles with it, its neighbour in the
+      history as a rule, and only copies or inflates the tiles that differ.
+
+Images rendered from another one by a deterministic function (sliders, curves,
+filters) can be stored as that base image and a replay function instead. Such an image
+drops its tiles instead of compressing them once it goes cold, and is rendered again
+from its base when it is used. Every KEYFRAME_INTERVAL-th image of a chain of renders
+keeps its tiles, which bounds the renders a replay takes.
+
+Hashing, splitting, compression and inflation run on the TileScheduler pool. The
+hashing pass also finds out, once per image, whether it has transparent pixels at all.
+While the editor is short of RAM (see ScratchDisk) the budget is taken as zero and
+compressed tiles are written to the scratch disk. Images and tiles are tracked weakly
+and leave the accounting once no history entry references them.
+"""
+
+import hashlib
+import weakref
+import zlib
+
+import numpy as np
+
+from ImageStats import ImageStats
+from QImageBridge import ArrayToQPixmap, QPixmapToArray
+from ScratchDisk import defaultScratchDisk
+from TileScheduler import defaultScheduler
+
+# Bytes of pixels kept by default, compressed ones included
+DEFAULT_BUDGET = 1024 * 1024 * 1024
+
+# Tile edge in pixels, and the zlib level: the fastest, history is written far more
+# often than it is read
+TILE_SIZE = 256
+LEVEL = 1
+
+# Most recently used images kept as QPixmaps, the current one and the one it was edited from
+FULL_FRAMES = 2
+
+# Renders at most between an image and the stored one it replays from
+KEYFRAME_INTERVAL = 8
+
+
+def tileSlices(height, width):
+    """ (rows, columns) slices of every tile of a height x width image, row by row """
+    return [(slice(top, min(top + TILE_SIZE, height)), slice(left, min(left + TILE_SIZE, width)))
+            for top in range(0, height, TILE_SIZE)
+            for left in range(0, width, TILE_SIZE)]
+
+
+def hashTile(buffer, tile):
+    """ SHA-256 hash of the pixels of a tile, and whether all of them are opaque """
+    pixels = np.ascontiguousarray(buffer[tile])
+    return hashlib.sha256(pixels).digest(), bool((pixels[..., 3] == 255).all())
+
+
+def copyTile(buffer, tile):
+    return buffer[tile].copy()
+
+
+def compressTile(pixels):
+    return zlib.compress(pixels, LEVEL)
+
+
+def readTile(tile, out):
+    pixels = tile.pixels
+    if pixels is not None:
+        out[...] = pixels
+    else:
+        out[...] = np.frombuffer(zlib.decompress(tile.data), dtype=np.uint8).reshape(out.shape)
+
+
+class Tile:
+
+    """ The pixels of one tile, shared by every image that has them. An array until the
+    budget runs out, then the zlib compressed pixels in data. """
+
+    __slots__ = ("pixels", "data", "__weakref__")
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.data = None
+
+    def compress(self, data):
+        self.data = defaultScratchDisk.store(data)
+        self.pixels = None
+
+
+class HistoryImage:
+
+    """ The pixels of one history entry, a QPixmap or shared Tiles or both """
+
+    def __init__(self, store, pixmap, digests, base=None, replay=None, hasAlpha=True):
+        self.store = store
+        self.width = pixmap.width()
+        self.height = pixmap.height()
+        self.nbytes = self.width * self.height * 4
+        self.lastUsed = 0
+
+        # Hash of every tile, in tileSlices() order
+        self.digests = digests
+        self._pixmap = pixmap
+        self._tiles = None
+
+        # False if every pixel is opaque, the viewer skips the transparency grid then
+        self.hasAlpha = hasAlpha
+
+        # Renders this image from a BGRA copy of base, images without one are keyframes
+        self.depth = 0 if base is None else base.depth + 1
+        if replay is None or self.depth > KEYFRAME_INTERVAL:
+            self.depth = 0
+            base = None
+            replay = None
+        self.base = base
+        self.replay = replay
+
+        # Referenced weakly, so dropping the entry frees the image right away
+        reference = weakref.ref(self)
+        self.stats = ImageStats(lambda: reference().view())
+
+    def isCompressed(self):
+        """ True if the pixmap has to be put together from tiles or replayed before use """
+        return self._pixmap is None
+
+    def pixmap(self):
+        """ The image as a QPixmap, put together first if it is split into tiles """
+        return self.store.use(self)
+
+    def buffer(self):
+        """ BGRA copy of the image, put together without making a pixmap if it is split """
+        if self._pixmap is not None:
+            return defaultScratchDisk.copy(QPixmapToArray(self._pixmap, writable=False))
+        return self.store.inflate(self)
+
+    def view(self):
+        """ Read-only BGRA view of the pixmap, no copy unless the image is split """
+        if self._pixmap is not None:
+            return QPixmapToArray(self._pixmap, writable=False)
+        return self.store.inflate(self)
+
+
+class HistoryStore:
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        # Bytes of pixels kept at most before images are compressed
+        self.budget = budget
+        self._images = weakref.WeakSet()
+        self._clock = 0
+
+        # Every stored image by its size and tile hashes, every compressed tile by its hash
+        self._contents = weakref.WeakValueDictionary()
+        self._tiles = weakref.WeakValueDictionary()
+
+    def setBudget(self, budget):
+        self.budget = budget
+        self.trim()
+
+    def add(self, pixmap, base=None, replay=None):
+        """ Stores pixmap, which must not be painted on afterwards, and returns its HistoryImage.
+        If an image with the same pixels is stored already, that one is returned.
+        base is the HistoryImage pixmap was rendered from and replay(buffer) the function that
+        renders it again from a writable BGRA copy of base, if it can be. """
+        buffer = QPixmapToArray(pixmap, writable=False)
+        hashes = defaultScheduler.starmap(hashTile, [(buffer, tile) for tile in tileSlices(*buffer.shape[:2])])
+        digests = [digest for digest, opaque in hashes]
+        key = (pixmap.width(), pixmap.height(), hashlib.sha256(b"".join(digests)).digest())
+
+        image = self._contents.get(key)
+        if image is None:
+            hasAlpha = pixmap.hasAlphaChannel() and not all(opaque for digest, opaque in hashes)
+            image = HistoryImage(self, pixmap, digests, base, replay, hasAlpha)
+            self._contents[key] = image
+            self._images.add(image)
+        elif image.isCompressed():
+            # Nothing to inflate, pixmap has its pixels
+            image._pixmap = pixmap
+        self.touch(image)
+        self.trim(image)
+        return image
+
+    def use(self, image):
+        """ Returns the pixmap of image, putting it together if it is split """
+        self.touch(image)
+        if image.isCompressed():
+            image._pixmap = ArrayToQPixmap(self.inflate(image))
+            self.trim(image)
+        return image._pixmap
+
+    def touch(self, image):
+        self._clock += 1
+        image.lastUsed = self._clock
+
+    def memoryBytes(self):
+        """ Returns (bytes of RAM in use, bytes of the images if every one was a full frame,
+        bytes on the scratch disk) """
+        images = list(self._images)
+        tiles = list(self._tiles.values())
+        used = sum(image.nbytes for image in images if not image.isCompressed())
+        used += sum(tile.pixels.nbytes for tile in tiles if tile.pixels is not None)
+        used += sum(len(tile.data) for tile in tiles if isinstance(tile.data, bytes))
+        scratch = sum(len(tile.data) for tile in tiles if tile.data is not None and not isinstance(tile.data, bytes))
+        return used, sum(image.nbytes for image in images), scratch
+
+    def trim(self, keep=None):
+        """ Splits every image but keep and the FULL_FRAMES most recently used ones into
+        tiles, then compresses the tiles of the least recently used images until the budget
+        is met. The most recently used image and keep are never compressed. """
+        images = sorted(self._images, key=lambda image: image.lastUsed)
+        for image in images[:-FULL_FRAMES]:
+            if image is not keep and not image.isCompressed():
+                self.split(image)
+
+        budget = 0 if defaultScratchDisk.isSpilling() else self.budget
+        used = self.memoryBytes()[0]
+        for image in images[:-1]:
+            if used <= budget:
+                break
+            if image is not keep and self.compress(image):
+                used = self.memoryBytes()[0]
+
+    def split(self, image):
+        """ Drops the pixmap of image, keeping its pixels as tiles shared with the other
+        stored images. Only the tiles no stored image has yet are copied. """
+        if image._tiles is None:
+            slices = tileSlices(image.height, image.width)
+            missing = {}
+            for tile, digest in zip(slices, image.digests):
+                if digest not in self._tiles and digest not in missing:
+                    missing[digest] = tile
+
+            created = {}
+            if missing:
+                buffer = QPixmapToArray(image._pixmap, writable=False)
+                copies = defaultScheduler.starmap(copyTile, [(buffer, tile) for tile in missing.values()])
+                for digest, pixels in zip(missing, copies):
+                    created[digest] = Tile(pixels)
+                    self._tiles[digest] = created[digest]
+            image._tiles = [created.get(digest) or self._tiles[digest] for digest in image.digests]
+        image._pixmap = None
+
+    def compress(self, image):
+        """ Compresses the tiles of a split image that are not compressed yet. An image
+        that can be replayed drops its tiles instead, other images may still share them.
+        Returns whether anything changed. """
+        if image._tiles is None or not image.isCompressed():
+            return False
+        if image.replay is not None:
+            image._tiles = None
+            return True
+
+        tiles = [tile for tile in dict.fromkeys(image._tiles) if tile.pixels is not None]
+        compressed = defaultScheduler.starmap(compressTile, [(tile.pixels,) for tile in tiles])
+        for tile, data in zip(tiles, compressed):
+            tile.compress(data)
+        return bool(tiles)
+
+    def inflate(self, image):
+        """ BGRA buffer of a split image. Starts from the pixmap of the same size sharing the
+        most tiles with it and copies or inflates only the tiles that differ. A replayable
+        image without tiles is rendered from its base instead. """
+        if image._tiles is None:
+            return image.replay(image.base.buffer())
+
+        reference = None
+        shared = 0
+        for other in list(self._images):
+            if other.isCompressed() or (other.width, other.height) != (image.width, image.height):
+                continue
+            count = sum(a == b for a, b in zip(other.digests, image.digests))
+            if count > shared:
+                reference = other
+                shared = count
+
+        slices = tileSlices(image.height, image.width)
+        if reference is None:
+            buffer = defaultScratchDisk.allocate((image.height, image.width, 4))
+            changed = range(len(slices))
+        else:
+            buffer = defaultScratchDisk.copy(QPixmapToArray(reference._pixmap, writable=False))
+            changed = [index for index, digest in enumerate(image.digests) if digest != reference.digests[index]]
+        defaultScheduler.starmap(readTile, [(image._tiles[index], buffer[slices[index]]) for index in changed])
+        return buffer
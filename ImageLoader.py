@@ -0,0 +1,80 @@
+""" ImageLoader.py: Decodes image files for a progressive open.
+
+readPreview() decodes a file straight to a reduced size, for formats whose Qt image plugin
+can (JPEG scales its DCT blocks while decoding), so a screen sized preview of a large photo
+shows long before the full image is decoded. readImage() decodes the full image and counts
+its histograms; it runs on a worker thread while the preview is shown. Images beyond the
+Qt allocation limit are decoded band by band by StreamDecoder, camera RAW files by
+RawDecoder, with the JPEG embedded in the file as the preview. RAW files without one get
+a preview from readWorkerPreview(), which is too slow for the GUI thread and runs on a
+worker ahead of readImage().
+
+All of them only touch QImage, never QPixmap, and are safe to call off the GUI thread.
+"""
+
+from PyQt6 import QtCore, QtGui
+
+from ImageStats import defaultEngine
+from QImageBridge import ArrayToQImage, QImageToArray
+from RawDecoder import decodeRaw, decodeRawPreview, isRaw, readRawPreview
+from StreamDecoder import decode, isBeyondAllocationLimit
+
+Format = QtGui.QImage.Format
+
+
+def readPreview(filepath, width, height):
+    """ Returns (QImage scaled to fit width x height, QSize of the full image), or None if the
+    image fits already or its format cannot decode at a reduced size """
+    if isRaw(filepath):
+        return readRawPreview(filepath, width, height)
+
+    reader = QtGui.QImageReader(filepath)
+    size = reader.size()
+    if not size.isValid() or (size.width() <= width and size.height() <= height):
+        return None
+    if not reader.supportsOption(QtGui.QImageIOHandler.ImageOption.ScaledSize):
+        return None
+
+    reader.setScaledSize(size.scaled(max(1, int(width)), max(1, int(height)), QtCore.Qt.AspectRatioMode.KeepAspectRatio))
+    image = reader.read()
+    if image.isNull():
+        return None
+    return image, size
+
+
+def readWorkerPreview(filepath):
+    """ Returns (QImage, QSize of the full image) of a preview for files readPreview() has
+    none for, or None. Only camera RAW files have one, a half size demosaic. """
+    if isRaw(filepath):
+        return decodeRawPreview(filepath)
+    return None
+
+
+def readImage(filepath, engine=None):
+    """ Returns (QImage, exact histograms) of filepath, or (null QImage, None) if it cannot be
+    read. The image is converted to the 32 bit format pixmaps take over without a copy.
+    Images QImageReader refuses for their size are read by StreamDecoder instead, camera
+    RAW files by RawDecoder. """
+    if isRaw(filepath):
+        buffer = decodeRaw(filepath)
+        if buffer is None:
+            return QtGui.QImage(), None
+        image = ArrayToQImage(buffer, format=Format.Format_RGB32)
+        return image, (engine or defaultEngine).histograms(buffer)
+
+    size = QtGui.QImageReader(filepath).size()
+    if size.isValid() and isBeyondAllocationLimit(size.width(), size.height()):
+        decoded = decode(filepath)
+        if decoded is None:
+            return QtGui.QImage(), None
+        buffer, hasAlpha = decoded
+        image = ArrayToQImage(buffer, format=None if hasAlpha else Format.Format_RGB32)
+        return image, (engine or defaultEngine).histograms(buffer)
+
+    image = QtGui.QImage(filepath)
+    if image.isNull():
+        return image, None
+    if image.format() not in (Format.Format_RGB32, Format.Format_ARGB32):
+        image = image.convertToFormat(Format.Format_ARGB32 if image.hasAlphaChannel() else Format.Format_RGB32)
+    histograms = (engine or defaultEngine).histograms(QImageToArray(image))
+    return image, histograms
@@ -0,0 +1,75 @@
+""" ImageStats.py: Statistics of one image, computed once and kept with its history entry.
+
+Histograms, channel means and extrema all follow from one exact histogram pass, which
+runs the first time any of them is asked for. Undo shows an old history entry again and
+its statistics come with it, so an image is never analysed twice.
+
+The pixels come from a source callable, which may read a pixmap and is then only called
+on the GUI thread; worker threads pass the BGRA buffer of the image they hold already.
+"""
+
+import threading
+
+import numpy as np
+
+from HistogramEngine import HistogramEngine, LUMA_HISTOGRAM
+
+defaultEngine = HistogramEngine()
+
+LEVELS = np.arange(256)
+
+
+class ImageStats:
+
+    def __init__(self, source, engine=None):
+        # Returns the BGRA buffer of the image, called once at most
+        self.source = source
+        self.engine = engine or defaultEngine
+        self._histograms = None
+        self._means = None
+
+        # Renders ask from worker threads
+        self._lock = threading.Lock()
+
+    def isComputed(self):
+        """ True once the histogram pass ran, every statistic is O(1) then """
+        return self._histograms is not None
+
+    def histograms(self, buffer=None):
+        """ Exact (4, 256) R, G, B and luma histograms, see HistogramEngine """
+        with self._lock:
+            if self._histograms is None:
+                if buffer is None:
+                    buffer = self.source()
+                histograms = self.engine.histograms(buffer)
+                histograms.flags.writeable = False
+                self._histograms = histograms
+            return self._histograms
+
+    def setHistograms(self, histograms):
+        """ Takes the exact histograms of the image, counted by a thread that had its pixels at hand """
+        with self._lock:
+            if self._histograms is None:
+                histograms.flags.writeable = False
+                self._histograms = histograms
+
+    def means(self, buffer=None):
+        """ Mean R, G, B and luma levels """
+        if self._means is None:
+            histograms = self.histograms(buffer)
+            self._means = histograms @ LEVELS / np.maximum(histograms.sum(axis=1), 1)
+        return self._means
+
+    def minimum(self, buffer=None):
+        """ Lowest R, G, B and luma levels present, 0 for an empty image """
+        histograms = self.histograms(buffer)
+        return np.array([np.flatnonzero(row)[0] if row.any() else 0 for row in histograms])
+
+    def maximum(self, buffer=None):
+        """ Highest R, G, B and luma levels present, 0 for an empty image """
+        histograms = self.histograms(buffer)
+        return np.array([np.flatnonzero(row)[-1] if row.any() else 0 for row in histograms])
+
+    def meanLuma(self, buffer=None):
+        """ Mean grey level rounded like ImageEnhance.Contrast, see PointOpCompiler.meanLuma """
+        return int(self.means(buffer)[LUMA_HISTOGRAM] + 0.5)
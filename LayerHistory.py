@@ -0,0 +1,80 @@
+""" LayerHistory.py: The undo history of one layer, with constant time lookups.
+
+Entries are pushed and popped at the end. Every entry remembers where the run of
+entries with its note, and the run with its type, started, so "the latest entry with a
+different note" (the source of a repeated LUT or slider change) is found without a
+scan.
+"""
+
+
+class HistoryEntry:
+
+    """ One change of a layer.
+
+    note    What changed, e.g. "Crop", "LUT", "Sliders"
+    image   HistoryImage of the result, see HistoryStore
+    type    "Tool", "Slider" or None
+    value   None or some value, e.g. 10
+    object  Name of the relevant object, e.g. "brightnessSlider"; undo uses it to set
+            parent.brightnessSlider back to value
+    """
+
+    __slots__ = ("note", "image", "type", "value", "object", "noteRunStart", "typeRunStart")
+
+    def __init__(self, note, image, type=None, value=None, object=None):
+        self.note = note
+        self.image = image
+        self.type = type
+        self.value = value
+        self.object = object
+
+        # Index of the first entry of the runs of equal notes and types this entry ends
+        self.noteRunStart = 0
+        self.typeRunStart = 0
+
+
+class LayerHistory:
+
+    def __init__(self):
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        return self._entries[index]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def push(self, entry):
+        index = len(self._entries)
+        latest = self._entries[-1] if self._entries else None
+        entry.noteRunStart = latest.noteRunStart if latest is not None and latest.note == entry.note else index
+        entry.typeRunStart = latest.typeRunStart if latest is not None and latest.type == entry.type else index
+        self._entries.append(entry)
+
+    def pop(self):
+        """ Removes and returns the latest entry """
+        return self._entries.pop()
+
+    def latest(self):
+        return self._entries[-1] if self._entries else None
+
+    def latestWithNoteOtherThan(self, note):
+        """ The latest entry whose note is not note, or None """
+        if not self._entries:
+            return None
+        latest = self._entries[-1]
+        if latest.note != note:
+            return latest
+        return self._entries[latest.noteRunStart - 1] if latest.noteRunStart > 0 else None
+
+    def latestWithTypeOtherThan(self, type):
+        """ The latest entry whose type is not type, or None """
+        if not self._entries:
+            return None
+        latest = self._entries[-1]
+        if latest.type != type:
+            return latest
+        return self._entries[latest.typeRunStart - 1] if latest.typeRunStart > 0 else None
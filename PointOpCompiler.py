@@ -0,0 +1,220 @@
+""" PointOpCompiler.py: Folds consecutive per-pixel point operations into one lookup table pass.
+
+A point operation maps every channel value through a function of that value alone:
+the red/green/blue factors, brightness, contrast and the tone curve are all of this
+kind. Any run of point operations therefore composes into a single 256 entry table per
+channel, which is applied to the BGRA buffer with one cv2.LUT call.
+
+Operations that look at neighbouring pixels or mix channels (saturation, sharpness,
+blur) are passed through unchanged and end the current run. Contrast needs the mean
+grey level of its input; it is resolved from the source pixels pushed through the
+tables composed so far, so it does not end the run either.
+
+runPasses can cache the output of every pass in a StageCache, so a chain whose leading
+passes did not change resumes from their cached output.
+"""
+
+import functools
+
+import numpy as np
+import cv2
+
+from ScratchDisk import defaultScratchDisk
+from TileScheduler import defaultScheduler
+
+# Channel indices of the BGRA working buffer
+BLUE = 0
+GREEN = 1
+RED = 2
+ALPHA = 3
+
+# Fixed point ITU-R 601-2 luma weights used by PIL's convert("L")
+LUMA_WEIGHTS = {RED: 19595, GREEN: 38470, BLUE: 7471}
+
+IDENTITY_TABLE = np.tile(np.arange(256, dtype=np.uint8), (4, 1))
+
+
+def luma(buffer, table=None):
+    """ ITU-R 601-2 luma of a BGRA buffer, rounded like PIL's convert("L").
+    If a (4, 256) table is given, the luma of the mapped buffer is returned. """
+    L = np.full(buffer.shape[:2], 0x8000, dtype=np.uint32)
+    for channel, weight in LUMA_WEIGHTS.items():
+        if table is None:
+            L += buffer[..., channel].astype(np.uint32) * weight
+        else:
+            weighted = table[channel].astype(np.uint32) * weight
+            L += weighted[buffer[..., channel]]
+    L >>= 16
+    return L.astype(np.uint8)
+
+
+def meanLuma(buffer, table=None):
+    """ Mean grey level as computed by ImageEnhance.Contrast """
+    histograms = defaultScheduler.reduce(lambda tile: np.bincount(luma(tile, table).ravel(), minlength=256), buffer)
+    histogram = np.sum(histograms, axis=0)
+    return int(np.dot(histogram, np.arange(256)) / max(histogram.sum(), 1) + 0.5)
+
+
+def channelTable(channel, factor):
+    """ channel.point(lambda i: i * factor) """
+    table = IDENTITY_TABLE.copy()
+    table[channel] = np.clip(np.round(np.arange(256) * factor), 0, 255)
+    return table
+
+
+def blendTable(degenerate, factor):
+    """ Image.blend of a solid degenerate grey level with the image, on R, G and B.
+    Computed in single precision and truncated like PIL's blend. """
+    values = np.arange(256, dtype=np.float32)
+    values -= np.float32(degenerate)
+    values *= np.float32(factor)
+    values += np.float32(degenerate)
+    np.clip(values, 0, 255, out=values)
+    table = IDENTITY_TABLE.copy()
+    table[[BLUE, GREEN, RED]] = values.astype(np.uint8)
+    return table
+
+
+def curveTable(lut):
+    """ The same 256 entry tone curve on R, G and B, alpha untouched """
+    table = IDENTITY_TABLE.copy()
+    table[[BLUE, GREEN, RED]] = np.asarray(lut, dtype=np.uint8).reshape(256)
+    return table
+
+
+def composeTables(first, second):
+    """ Table equivalent to applying first, then second """
+    if first is None:
+        return second
+    return np.take_along_axis(second, first.astype(np.intp), axis=1)
+
+
+def inPlace(function):
+    """ Marks a stage function that writes its result into its input buffer """
+    function.inPlace = True
+    return function
+
+
+def isInPlace(stage):
+    return getattr(getattr(stage, "func", stage), "inPlace", False)
+
+
+def stageKey(stage):
+    """ Hashable description of a stage and its parameters """
+    if isinstance(stage, (PointOp, LUTPass)):
+        return stage.key()
+    if isinstance(stage, functools.partial):
+        return (stageKey(stage.func), stage.args, tuple(sorted(stage.keywords.items())))
+    return (stage.__module__, stage.__qualname__)
+
+
+def applyTable(buffer, table):
+    """ Maps all four channels of buffer through table in one pass, in place """
+    lut = np.ascontiguousarray(table.T).reshape(256, 1, 4)
+    return defaultScheduler.map(lambda tile: cv2.LUT(tile, lut, dst=tile), buffer, out=buffer)
+
+
+class PointOp:
+
+    """ A per-pixel operation described by a (4, 256) table.
+    Pass tableForMean instead of table if the table depends on the mean grey level of
+    the incoming image; it is called with that mean when the chain runs. """
+
+    def __init__(self, table=None, tableForMean=None):
+        self._table = table
+        self._tableForMean = tableForMean
+
+    def table(self, buffer, previous):
+        if self._tableForMean is not None:
+            return self._tableForMean(meanLuma(buffer, previous))
+        return self._table
+
+    def isFixed(self):
+        """ True if the table does not depend on the image """
+        return self._tableForMean is None
+
+    def key(self):
+        if self._tableForMean is not None:
+            return stageKey(self._tableForMean)
+        return self._table.tobytes()
+
+
+class LUTPass:
+
+    """ A run of consecutive point operations, applied as one table """
+
+    # The table is applied to the buffer passed in
+    inPlace = True
+
+    def __init__(self, ops):
+        self.ops = ops
+
+    def key(self):
+        return tuple(op.key() for op in self.ops)
+
+    def table(self, buffer):
+        table = None
+        for op in self.ops:
+            table = composeTables(table, op.table(buffer, table))
+        return table
+
+    def __call__(self, buffer):
+        return applyTable(buffer, self.table(buffer))
+
+
+def compileStages(stages):
+    """ Groups consecutive PointOps into LUTPasses.
+    Every other stage is a callable taking and returning a buffer, and is kept as is. """
+    passes = []
+    run = []
+    for stage in stages:
+        if isinstance(stage, PointOp):
+            run.append(stage)
+            continue
+        if run:
+            passes.append(LUTPass(run))
+            run = []
+        passes.append(stage)
+    if run:
+        passes.append(LUTPass(run))
+    return passes
+
+
+def runPasses(passes, buffer, isCancelled=None, cache=None, key=None):
+    """ Runs compiled passes on buffer, returns the result.
+    If isCancelled() turns True between two passes, None is returned instead.
+
+    Passes marked inPlace write to buffer. Given a StageCache and a key identifying the
+    contents of buffer, the output of every pass is cached instead and the passes whose
+    output is cached already are skipped; buffer and the result are then read-only. """
+    if cache is None:
+        for stage in passes:
+            if isCancelled is not None and isCancelled():
+                return None
+            buffer = stage(buffer)
+        return buffer
+
+    keys = []
+    prefix = key
+    for stage in passes:
+        prefix = (prefix, stageKey(stage))
+        keys.append(prefix)
+
+    # Resume from the output of the longest cached run of leading passes
+    start = 0
+    for index in range(len(passes), 0, -1):
+        cached = cache.get(keys[index - 1])
+        if cached is not None:
+            buffer = cached
+            start = index
+            break
+
+    for stage, passKey in zip(passes[start:], keys[start:]):
+        if isCancelled is not None and isCancelled():
+            return None
+        if isInPlace(stage):
+            # Neither the caller's buffer nor a cached one may be written to
+            buffer = defaultScratchDisk.copy(buffer)
+        # The pass output in RAM is dropped for the cached copy if that went to the scratch disk
+        buffer = cache.put(passKey, stage(buffer))
+    return buffer
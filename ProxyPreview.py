@@ -0,0 +1,74 @@
+""" ProxyPreview.py: Downscaled slider renders while a slider is being dragged.
+
+The proxy is never larger than the image is shown on screen. Its pixel count is further
+limited by how many pixels the adjustment engine managed to render within the frame
+budget so far, so a drag stays interactive on slow machines and heavy slider states.
+"""
+
+import math
+import threading
+
+import cv2
+
+
+class ProxyPreview:
+
+    """ Sizes and caches the proxy of the slider source image """
+
+    def __init__(self, frameBudget=1.0 / 30, minimumPixels=256 * 256):
+        # Seconds a proxy render may take
+        self.frameBudget = frameBudget
+
+        # Never shrink the proxy below this many pixels, however slow the render
+        self.minimumPixels = minimumPixels
+
+        # Pixels that fit in the frame budget, unknown until a render was timed
+        self.targetPixels = None
+
+        self._proxyKey = None
+        self._proxy = None
+
+        # Proxies are built on render worker threads
+        self._lock = threading.Lock()
+
+    def proxySize(self, width, height, displayWidth, displayHeight):
+        """ Returns the (width, height) of the proxy for an image shown at the given display size """
+        scale = min(1.0, displayWidth / width, displayHeight / height)
+        if self.targetPixels is not None:
+            scale = min(scale, math.sqrt(self.targetPixels / (width * height)))
+
+        # Quarter octave steps, so small budget changes keep reusing the cached proxy
+        scale = 2 ** (math.floor(math.log2(max(scale, 1e-6)) * 4) / 4)
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    def proxy(self, key, source, displayWidth, displayHeight):
+        """ Returns the proxy of source, a BGRA buffer identified by key.
+        The proxy is cached and must not be written to. """
+        height, width = source.shape[:2]
+        size = self.proxySize(width, height, displayWidth, displayHeight)
+        with self._lock:
+            if self._proxyKey != (key, size):
+                if size == (width, height):
+                    self._proxy = source
+                else:
+                    self._proxy = cv2.resize(source, size, interpolation=cv2.INTER_AREA)
+                    self._proxy.flags.writeable = False
+                self._proxyKey = (key, size)
+            return self._proxy
+
+    def recordRenderTime(self, seconds, pixels):
+        """ Adapts the pixel budget to the time a proxy render of the given size took """
+        if seconds <= 0:
+            return
+        target = max(self.minimumPixels, pixels / seconds * self.frameBudget)
+        if self.targetPixels is None:
+            self.targetPixels = target
+        else:
+            # Smooth out single slow frames
+            self.targetPixels = 0.5 * self.targetPixels + 0.5 * target
+
+    def clear(self):
+        """ Releases the cached proxy """
+        with self._lock:
+            self._proxyKey = None
+            self._proxy = None
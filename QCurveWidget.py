@@ -9,7 +9,10 @@ from PyQt6.QtGui import QPixmap
 from panda3d.core import NurbsCurve, Vec3, Notify, HermiteCurve, CurveFitter
 import numpy as np
 import cv2
-from PIL import Image
+
+from PointOpCompiler import PointOp, compileStages, curveTable, runPasses
+from QImageBridge import ArrayToQPixmap, QPixmapToArray
+from ScratchDisk import defaultScratchDisk
 
 # https://discourse.panda3d.org/t/pyqt-curve-editor-curvefitter-example/15207
 # https://stackoverflow.com/questions/64718236/how-to-perform-color-tone-adjustments-and-write-a-look-up-table
@@ -145,20 +148,6 @@ class QCurveWidget(QtWidgets.QWidget):
         # (CurveIndex, PointIndex)
         self._selected_point = None
 
-    def QPixmapToImage(self, pixmap):
-        from PIL import Image
-        width = pixmap.width()
-        height = pixmap.height()
-        image = pixmap.toImage()
-
-        byteCount = image.bytesPerLine() * height
-        data = image.constBits().asstring(byteCount)
-        return Image.frombuffer('RGBA', (width, height), data, 'raw', 'BGRA', 0, 1)
-
-    def ImageToQPixmap(self, image):
-        from PIL.ImageQt import ImageQt
-        return QPixmap.fromImage(ImageQt(image))
-
     def paintEvent(self, e):
         """ Internal QT paint event, draws the entire widget """
         qp = QtGui.QPainter()
@@ -212,11 +201,8 @@ class QCurveWidget(QtWidgets.QWidget):
 
     def updateImage(self):
         # Perform LUT on mouse release
-        pixmap = self.viewer.getCurrentLayerLatestPixmapBeforeLUTChange()
-        image = self.QPixmapToImage(pixmap)
-        arr = np.asarray(image)
-        b, g, r, a = cv2.split(arr)
-        arr = np.dstack((b, g, r))
+        base = self.viewer.getCurrentLayerLatestImageBeforeLUTChange()
+        pixmap = base.pixmap()
 
         bar_curve = self.curves[0]
         canvas_width = self.width() - self._legend_border
@@ -232,14 +218,25 @@ class QCurveWidget(QtWidgets.QWidget):
         # interpolate nearest neighbor to have 256x1 pixel image of 8 colors in blocks of 32
         lut = cv2.resize(colorArray, (256,1), 0, 0, interpolation = cv2.INTER_NEAREST)
 
-        # apply lut
-        result = cv2.LUT(arr, lut)
-
-        # Save result
-        newImage = np.dstack((result, a))
-        newImage = Image.fromarray(newImage)
-        updatedPixmap = self.ImageToQPixmap(newImage)
-        self.viewer.setImage(updatedPixmap, True, "LUT")
+        # apply lut to R, G and B in a single pass, alpha is left untouched
+        # With a selection only its bounding box is mapped, then blended back through its mask
+        table = curveTable(lut[0, :, 0])
+        passes = compileStages([PointOp(table)])
+        mask = self.viewer.selectionMask()
+
+        def applyCurve(buffer):
+            if mask is None:
+                return runPasses(passes, buffer)
+            region = runPasses(passes, defaultScratchDisk.copy(mask.crop(buffer)))
+            return mask.composite(buffer, region, out=buffer)
+
+        buffer = applyCurve(defaultScratchDisk.copy(QPixmapToArray(pixmap, writable=False)))
+
+        # Save result, its histogram is the source histogram remapped through the curve
+        # The history keeps the curve and renders it again from base once the result is cold
+        updatedPixmap = ArrayToQPixmap(buffer)
+        self.viewer.parent.DeriveNextHistogram(base, table)
+        self.viewer.setImage(updatedPixmap, True, "LUT", base=base, replay=applyCurve)
 
     def _get_y_value_for(self, local_value):
         """ Converts a value from 0 to 1 to a value from 0 .. canvas height """
@@ -0,0 +1,168 @@
+""" QImageBridge.py: Shares pixel memory between QImage and NumPy arrays.
+
+QImageToArray returns a (height, width, 4) uint8 view of the pixels of a QImage and
+ArrayToQImage wraps an array in a QImage, neither copies pixels. Rows may be padded:
+the row stride of the array is the bytesPerLine of the image and the other way round.
+
+Channels are addressed by byte order in memory. Format_ARGB32 stores 0xAARRGGBB words,
+which are the bytes B, G, R, A on little-endian machines; Format_RGBA8888 stores the bytes
+R, G, B, A everywhere. Asking for the byte order the image already has gives a view,
+anything else is converted once. The editor works on "BGRA" buffers.
+
+A view keeps its QImage alive and a wrapped QImage keeps its array alive, so either side
+may be dropped first. Both sides still share memory, writing to one shows in the other.
+
+QPixmap and QImage are reference counted and copy on write, which makes them the image
+handles of the editor: the viewer, the history and the tools pass the same pixmap around
+and read it through read-only views. Pixels are only copied by a writable array, which is
+the output buffer of an edit, and an opaque output buffer becomes the pixmap of the
+result as it is (see ArrayToQPixmap). Pixmaps are never painted on once made.
+
+The PIL helpers at the end are for code that needs PIL images (pilgram); they copy
+exactly once, to reorder the channels.
+"""
+
+import sys
+
+import numpy as np
+from PyQt6 import QtGui, sip
+from PIL import Image
+
+Format = QtGui.QImage.Format
+
+# Byte order of the 32 bit QImage formats, alpha reads 0xff in the formats without alpha
+if sys.byteorder == "little":
+    WORD_ORDER = "BGRA"
+else:
+    WORD_ORDER = "ARGB"
+
+BYTE_ORDER = {
+    Format.Format_ARGB32: WORD_ORDER,
+    Format.Format_RGB32: WORD_ORDER,
+    Format.Format_RGBA8888: "RGBA",
+    Format.Format_RGBX8888: "RGBA",
+}
+
+# Format to convert to for a byte order, and to wrap arrays of that byte order in
+FORMAT = {
+    WORD_ORDER: Format.Format_ARGB32,
+    "RGBA": Format.Format_RGBA8888,
+}
+
+
+def reorder(array, source, target):
+    """ Returns a copy of array with its channels moved from byte order source to target """
+    return np.ascontiguousarray(array[..., [source.index(channel) for channel in target]])
+
+
+class QImageMemory:
+
+    """ Exposes the pixels of a QImage to NumPy and keeps the QImage alive while they are used """
+
+    def __init__(self, image, writable):
+        self.image = image
+        # bits() detaches an implicitly shared image first, so writes never reach other copies
+        data = image.bits() if writable else image.constBits()
+        channels = image.depth() // 8
+        self.__array_interface__ = {
+            "version": 3,
+            "typestr": "|u1",
+            "data": (int(data), not writable),
+            "shape": (image.height(), image.width(), channels) if channels > 1 else (image.height(), image.width()),
+            "strides": (image.bytesPerLine(), channels, 1) if channels > 1 else (image.bytesPerLine(), 1),
+        }
+
+
+def QImageToArray(image, order="BGRA", writable=False):
+    """ Returns the pixels of image as a (height, width, 4) uint8 array in the given byte order.
+    The array is a view of the image memory if the image has that byte order already.
+    Pass writable=True to modify the pixels; the view is read-only otherwise. """
+    if image.isNull():
+        return np.zeros((0, 0, 4), dtype=np.uint8)
+
+    imageOrder = BYTE_ORDER.get(image.format())
+    if imageOrder != order:
+        if order not in FORMAT:
+            # No QImage format has this byte order on this machine
+            return reorder(QImageToArray(image, "RGBA"), "RGBA", order)
+        image = image.convertToFormat(FORMAT[order])
+    return np.asarray(QImageMemory(image, writable))
+
+
+def QImageToAlpha(image, writable=False):
+    """ Returns the pixels of an 8 bit image (Format_Alpha8, Format_Grayscale8) as a
+    (height, width) uint8 view of the image memory """
+    if image.format() not in (Format.Format_Alpha8, Format.Format_Grayscale8):
+        image = image.convertToFormat(Format.Format_Alpha8)
+    return np.asarray(QImageMemory(image, writable))
+
+
+def ArrayToQImage(array, order="BGRA", format=None):
+    """ Wraps a (height, width, 4) uint8 array in a QImage without copying.
+    Rows may be padded, pixels must be packed; other arrays are copied first.
+    format overrides the format of the byte order with another 32 bit format of the same
+    layout, e.g. Format_ARGB32_Premultiplied for the raw pixels of such an image. """
+    if order not in FORMAT:
+        array = reorder(array, order, "RGBA")
+        order = "RGBA"
+    if array.dtype != np.uint8 or array.strides[1:] != (4, 1) or array.strides[0] < 0 or array.strides[0] % 4:
+        array = np.ascontiguousarray(array, dtype=np.uint8)
+
+    height, width = array.shape[:2]
+    # Qt hands array back to the cleanup function once the last QImage sharing it is gone
+    return QtGui.QImage(sip.voidptr(array.ctypes.data), width, height, array.strides[0], format or FORMAT[order], releaseArray, array)
+
+
+def releaseArray(array):
+    """ QImage cleanup function, dropping the reference is all there is to do """
+
+
+def QPixmapToArray(pixmap, order="BGRA", writable=True):
+    """ Returns an array of the pixmap pixels.
+    A writable array is a copy the caller owns. With writable=False the array is a read-only
+    view of the pixmap memory where the byte order allows it: raster pixmaps share their
+    QImage with toImage(), so reading the pixels of a pixmap copies nothing. """
+    return QImageToArray(pixmap.toImage(), order, writable)
+
+
+def ArrayToQPixmap(array, order="BGRA"):
+    """ Uploads the array into a new QPixmap.
+    If every pixel is opaque, the array is wrapped as Format_RGB32, which a raster pixmap
+    takes as its memory instead of copying it; nothing may write to array afterwards then.
+    Other arrays are converted to the premultiplied format of pixmaps, which copies. """
+    if order == WORD_ORDER and array.size and array[..., WORD_ORDER.index("A")].min() == 255:
+        return QtGui.QPixmap.fromImage(ArrayToQImage(array, order, Format.Format_RGB32))
+    return QtGui.QPixmap.fromImage(ArrayToQImage(array, order))
+
+
+def ArrayToImage(array, order="BGRA"):
+    """ Copies a (height, width, 4) uint8 array in the given byte order into an RGBA PIL image """
+    # Cropped arrays and images wrapped around them have padded rows
+    array = np.ascontiguousarray(array)
+    height, width = array.shape[:2]
+    return Image.frombuffer("RGBA", (width, height), array, "raw", order, 0, 1)
+
+
+def ImageToQImage(image):
+    """ Copies a PIL image into a QImage """
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    return ArrayToQImage(np.asarray(image), "RGBA")
+
+
+def ImageToArray(image, order="BGRA", out=None):
+    """ Copies a PIL image into a (height, width, 4) uint8 array in the given byte order,
+    into out if given """
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    if out is None:
+        return reorder(np.asarray(image), "RGBA", order)
+    pixels = np.asarray(image)
+    for index, channel in enumerate(order):
+        out[..., index] = pixels[..., "RGBA".index(channel)]
+    return out
+
+
+def ImageToQPixmap(image):
+    """ Uploads a PIL image into a new QPixmap """
+    return QtGui.QPixmap.fromImage(ImageToQImage(image))
@@ -2,15 +2,20 @@
 """
 
 import os.path
+import time
 
 from PyQt6 import QtCore, QtGui, QtWidgets
 from PyQt6.QtCore import Qt, QRect, QRectF, QPoint, QPointF, pyqtSignal, QEvent, QSize
-from PyQt6.QtGui import QImage, QPixmap, QPainterPath, QMouseEvent, QPainter, QPen
+from PyQt6.QtGui import QImage, QPixmap, QPainterPath, QMouseEvent, QPainter, QPen, QBrush, QColor
 from PyQt6.QtWidgets import QGraphicsView, QGraphicsScene, QFileDialog, QSizePolicy, \
     QGraphicsItem, QGraphicsEllipseItem, QGraphicsRectItem, QGraphicsLineItem, QGraphicsPolygonItem
 
-from PIL import Image, ImageFilter, ImageDraw
-from PIL.ImageQt import ImageQt
+from HistoryStore import HistoryStore
+from ImageLoader import readImage, readPreview, readWorkerPreview
+from LayerHistory import HistoryEntry, LayerHistory
+from QRenderWorker import QRenderQueue
+from QTiledImageItem import QTiledImageItem
+from SelectionMask import SelectionMask
 
 class QtImageViewer(QGraphicsView):
     
@@ -38,21 +43,34 @@ class QtImageViewer(QGraphicsView):
     # Emit index of selected ROI
     roiSelected = pyqtSignal(int)
 
+    # Emitted once an opened image is in the history, with the seconds to its first pixel
+    # on screen and to the full image
+    imageOpened = pyqtSignal(float, float)
+
+    # Emitted when a file starts to open, the history still holds the previous image until
+    # imageOpened, or imageOpenFailed with the path of a file that could not be read
+    imageOpening = pyqtSignal()
+    imageOpenFailed = pyqtSignal(str)
+
     def __init__(self, parent):
         QGraphicsView.__init__(self)
         
         self.parent = parent
 
-        # Image is displayed as a QPixmap in a QGraphicsScene attached to this QGraphicsView.
+        # Image is displayed as the tiles of a QTiledImageItem in a QGraphicsScene attached to this QGraphicsView.
         self.scene = QGraphicsScene()
         self.setScene(self.scene)
 
-        # Better quality pixmap scaling?
-        # self.setRenderHints(QPainter.Antialiasing | QPainter.SmoothPixmapTransform)
+        # Zoomed out views are drawn smoothly from the mipmap levels of QTiledImageItem,
+        # zoomed in ones keep the actual pixels
 
         # Displayed image pixmap in the QGraphicsScene.
         self._current_filename = None
         self._image = None
+        self._isShowingPreview = False
+
+        # ImageStats of the displayed image if it is the pixmap of a history entry
+        self._imageStats = None
 
         # Image aspect ratio mode.
         #   Qt.IgnoreAspectRatio: Scale image to fit viewport.
@@ -114,6 +132,9 @@ class QtImageViewer(QGraphicsView):
         self.pathPointItem = None
         self.selectPainterPointPaths = []
 
+        # Rasterized active selection, see selectionMask()
+        self._selectionMask = None
+
         self._isCropping = False
 
         # Flags for spot removal tool
@@ -159,14 +180,30 @@ class QtImageViewer(QGraphicsView):
         ##############################################################################################
 
         self.layerHistory = {
-            0: []    
+            0: LayerHistory()
         }
+
+        # Pixels of every history entry, compressed beyond its budget
+        self.historyStore = HistoryStore()
+
+        # Opened files are decoded on the thread pool, opening another one drops the previous
+        self.openQueue = QRenderQueue(QtCore.QThreadPool.globalInstance(), [])
+        self.openQueue.completedSignal.connect(self.onOpenCompleted)
+        self.openQueue.failedSignal.connect(self.onOpenFailed)
+        # Previews too slow for the GUI thread, decoded on the pool ahead of the full image
+        self.previewQueue = QRenderQueue(QtCore.QThreadPool.globalInstance(), [])
+        self.previewQueue.completedSignal.connect(self.onOpenPreviewCompleted)
+        # File being decoded, it becomes the current file once it is in the history
+        self._openingFilename = None
+        self._openStart = 0
+        self._openFirstPixel = None
         self.currentLayer = 0
         self.numLayersCreated = 1
 
-        self.checkerBoard = None
-        self.checkerBoardWidth = 0
-        self.checkerBoardHeight = 0
+        # Transparency grid, drawn only under images with transparent pixels
+        self._hasAlpha = False
+        self._checkerBrush = None
+        self._checkerSize = 0
 
         # Reference to dock widget that shows layer list
         self.layerListDock = None
@@ -209,201 +246,185 @@ class QtImageViewer(QGraphicsView):
             return self._image.pixmap().toImage()
         return None
 
+    def imageStats(self):
+        """ Returns the ImageStats of the displayed image, or None if it is not the pixmap of a
+        history entry (a slider or filter preview, an image with an overlay).
+        :rtype: ImageStats | None
+        """
+        if self.hasImage():
+            return self._imageStats
+        return None
+
+    def selectionMask(self):
+        """ Returns the SelectionMask of the active rectangle or path selection over the current
+        image, or None if nothing is selected. The selection is rasterized once and reused until
+        it or the image size changes.
+        :rtype: SelectionMask | None
+        """
+        pixmap = self.pixmap()
+        if not pixmap:
+            return None
+        width = pixmap.width()
+        height = pixmap.height()
+
+        if self._isSelectingRect and self._selectRect is not None and self._selectRect.isValid():
+            # Keyed by the rect clipped to the image, like the mask
+            rect = self._selectRect.toRect()
+            key = SelectionMask.rectKey(rect, width, height)
+            if key is None:
+                return None
+            if self._selectionMask is None or self._selectionMask.key != key:
+                self._selectionMask = SelectionMask.fromRect(rect, width, height)
+        elif self._isSelectingPath and len(self.selectPoints) > 2:
+            key = SelectionMask.polygonKey(self.selectPoints, width, height)
+            if self._selectionMask is None or self._selectionMask.key != key:
+                self._selectionMask = SelectionMask.fromPolygon(self.selectPoints, width, height)
+        else:
+            return None
+        return self._selectionMask
+
+    def getCurrentLayerHistory(self):
+        """ Returns the LayerHistory of the current layer, or None.
+        :rtype: LayerHistory | None
+        """
+        return self.layerHistory.get(self.currentLayer)
+
     def getCurrentLayerPixmapBeforeChangeTo(self, changeName):
-        if self.currentLayer in self.layerHistory:
-            history = self.layerHistory[self.currentLayer]
-            i = len(history)
-            while i > 0:
-                entry = history[i - 1]
-                if entry["note"] != changeName:
-                    return entry["pixmap"]
-                i -= 1
+        history = self.getCurrentLayerHistory()
+        if history:
+            entry = history.latestWithNoteOtherThan(changeName)
+            if entry:
+                return entry.image.pixmap()
         return None
 
     def undoCurrentLayerLatestChange(self):
-        if self.currentLayer in self.layerHistory:
-            history = self.layerHistory[self.currentLayer]
-            if len(history) > 1:
-                previous = history[-2]
-                latest = history[-1]
-
-                if latest["type"] == "Tool" and latest["note"] == "Path Select":
-                    # Undo path selection
-                    if self.path:
-                        self.path.clear()
-
-                    for pathItem in self.selectPainterPaths:
-                        if pathItem and pathItem in self.scene.items():
-                            self.scene.removeItem(pathItem)
-
-                    for pathPointItem in self.selectPainterPointPaths:
-                        if pathPointItem and pathPointItem in self.scene.items():
-                            self.scene.removeItem(pathPointItem)
-
-                    if previous["note"] == "Path Select":
-                        self.selectPoints, self.selectPainterPaths, self.selectPainterPointPaths = previous["value"]
-                        if len(self.selectPoints) > 1:
-                            self.buildPath(addToHistory=False)
-
-                            # Remove the last entry from the history
-                            self.layerHistory[self.currentLayer] = history[:-1]
-                        else:
-                            # Remove the last 2 entries from the history
-                            self.layerHistory[self.currentLayer] = history[:-2]
-                            self.selectPoints = []
-                            self.selectPainterPaths = []
-                            self.selectPainterPointPaths = []
+        history = self.getCurrentLayerHistory()
+        if history and len(history) > 1 and not self.isOpening():
+            previous = history[-2]
+            latest = history[-1]
+
+            if latest.type == "Tool" and latest.note == "Path Select":
+                # Undo path selection
+                if self.path:
+                    self.path.clear()
+
+                for pathItem in self.selectPainterPaths:
+                    if pathItem and pathItem in self.scene.items():
+                        self.scene.removeItem(pathItem)
+
+                for pathPointItem in self.selectPainterPointPaths:
+                    if pathPointItem and pathPointItem in self.scene.items():
+                        self.scene.removeItem(pathPointItem)
+
+                if previous.note == "Path Select":
+                    self.selectPoints, self.selectPainterPaths, self.selectPainterPointPaths = previous.value
+                    if len(self.selectPoints) > 1:
+                        self.buildPath(addToHistory=False)
+
+                        # Remove the last entry from the history
+                        history.pop()
                     else:
-                        # Previous is not a path select
                         # Remove the last 2 entries from the history
-                        self.layerHistory[self.currentLayer] = history[:-1]
+                        history.pop()
+                        history.pop()
                         self.selectPoints = []
                         self.selectPainterPaths = []
                         self.selectPainterPointPaths = []
-
-                elif previous["type"] == "Slider":
-                    if previous["value"]:
-                        slider = getattr(self.parent, previous["object"])
-                        slider.setValue(previous["value"])
-                        setattr(self.parent, previous["object"], slider)
-
-                        # Remove the last two entries
-                        self.layerHistory[self.currentLayer] = history[:-2]
-                        self.setImage(previous["pixmap"], True, previous["note"], previous["type"], previous["value"], previous["object"])
-                        # Update GUI object value, e.g., slider setting
-                
-                        if len(self.layerHistory[self.currentLayer]) == 0:
-                            self.layerHistory[self.currentLayer].append(previous)
                 else:
-                    # Generic undo
-                    # Remove the last two entries
-                    self.layerHistory[self.currentLayer] = history[:-2]
-                    self.setImage(previous["pixmap"], True, previous["note"], previous["type"], previous["value"], previous["object"])
+                    # Previous is not a path select
+                    # Remove the last entry from the history
+                    history.pop()
+                    self.selectPoints = []
+                    self.selectPainterPaths = []
+                    self.selectPainterPointPaths = []
+
+            elif previous.type == "Slider":
+                if previous.value:
                     # Update GUI object value, e.g., slider setting
-                
-                    if len(self.layerHistory[self.currentLayer]) == 0:
-                        self.layerHistory[self.currentLayer].append(previous)
+                    slider = getattr(self.parent, previous.object)
+                    slider.setValue(previous.value)
+                    setattr(self.parent, previous.object, slider)
+
+                    # Remove the last two entries, setImage() adds previous back
+                    history.pop()
+                    history.pop()
+                    self.setImage(previous.image.pixmap(), True, previous.note, previous.type, previous.value, previous.object, previous.image)
+            else:
+                # Generic undo
+                # Remove the last two entries, setImage() adds previous back
+                history.pop()
+                history.pop()
+                self.setImage(previous.image.pixmap(), True, previous.note, previous.type, previous.value, previous.object, previous.image)
 
     def getCurrentLayerLatestPixmap(self):
-        if self.currentLayer in self.layerHistory:
-            # Layer name checks out
-            history = self.layerHistory[self.currentLayer]
-            
-            # History structure
-            #
-            # List of objects
-            # {
-            #    "note"   : "Crop",
-            #    "pixmap" : QPixmap(...)
-            #    "type"   : "Tool" or "Slider"
-            #    "value"  : None or some value e.g., 10
-            #    "object" : Relevant object, e.g., brightnessSlider <- will be used to update parent.brightnessSlider.setValue(...)
-            # }
-
-            if len(history) > 0:
-                # Get most recent
-                entry = history[-1]
-                if "pixmap" in entry:
-                    return entry["pixmap"]
+        image = self.getCurrentLayerLatestImage()
+        if image:
+            return image.pixmap()
         return None
 
     def getCurrentLayerPreviousPixmap(self):
-        if self.currentLayer in self.layerHistory:
-            # Layer name checks out
-            history = self.layerHistory[self.currentLayer]
-            
-            # History structure
-            #
-            # List of objects
-            # {
-            #    "note"   : "Crop",
-            #    "pixmap" : QPixmap(...)
-            #    "type"   : "Tool" or "Slider"
-            #    "value"  : None or some value e.g., 10
-            #    "object" : Relevant object, e.g., brightnessSlider <- will be used to update parent.brightnessSlider.setValue(...)
-            # }
-
-            if len(history) > 1:
-                # Get most recent
-                entry = history[-2]
-                if "pixmap" in entry:
-                    return entry["pixmap"]
+        history = self.getCurrentLayerHistory()
+        if history and len(history) > 1:
+            return history[-2].image.pixmap()
         return None
 
     def getCurrentLayerLatestPixmapBeforeSliderChange(self):
-        if self.currentLayer in self.layerHistory:
-            # Layer name checks out
-            history = self.layerHistory[self.currentLayer]
-            
-            # History structure
-            #
-            # List of objects
-            # {
-            #    "note"   : "Crop",
-            #    "pixmap" : QPixmap(...)
-            #    "Type"   : "Tool" or "Slider"
-            #    "value"  : None or some value e.g., 10
-            #    "object" : Relevant object, e.g., brightnessSlider <- will be used to update parent.brightnessSlider.setValue(...)
-            # }
-
-            i = len(history)
-            while i > 0:
-                entry = history[i - 1]
-                if "pixmap" in entry and entry["type"] != "Slider":
-                    return entry["pixmap"]
-                i -= 1
-
+        history = self.getCurrentLayerHistory()
+        if history:
+            entry = history.latestWithTypeOtherThan("Slider")
+            if entry:
+                return entry.image.pixmap()
         return None
 
     def getCurrentLayerLatestPixmapBeforeLUTChange(self):
-        if self.currentLayer in self.layerHistory:
-            # Layer name checks out
-            history = self.layerHistory[self.currentLayer]
-            
-            # History structure
-            #
-            # List of objects
-            # {
-            #    "note"   : "Crop",
-            #    "pixmap" : QPixmap(...)
-            #    "Type"   : "Tool" or "Slider"
-            #    "value"  : None or some value e.g., 10
-            #    "object" : Relevant object, e.g., brightnessSlider <- will be used to update parent.brightnessSlider.setValue(...)
-            # }
-
-            i = len(history)
-            while i > 0:
-                entry = history[i - 1]
-                if "pixmap" in entry and entry["note"] != "LUT":
-                    return entry["pixmap"]
-                i -= 1
+        image = self.getCurrentLayerLatestImageBeforeLUTChange()
+        if image:
+            return image.pixmap()
+        return None
 
+    def getCurrentLayerLatestImageBeforeLUTChange(self):
+        history = self.getCurrentLayerHistory()
+        if history:
+            entry = history.latestWithNoteOtherThan("LUT")
+            if entry:
+                return entry.image
         return None
 
-    def addToHistory(self, pixmap, explanationOfChange, typeOfChange, valueOfChange, objectOfChange):
-        self.layerHistory[self.currentLayer].append({
-            "note": explanationOfChange,
-            "pixmap": pixmap,
-            "type": typeOfChange,
-            "value": valueOfChange,
-            "object": objectOfChange
-        })
+    def getCurrentLayerLatestImage(self):
+        history = self.getCurrentLayerHistory()
+        if history:
+            return history[-1].image
+        return None
+
+    def getCurrentLayerLatestStats(self):
+        image = self.getCurrentLayerLatestImage()
+        if image:
+            return image.stats
+        return None
+
+    def addToHistory(self, image, explanationOfChange, typeOfChange, valueOfChange, objectOfChange):
+        # image is a HistoryImage of historyStore, entries restored by undo share theirs
+        self.layerHistory[self.currentLayer].push(HistoryEntry(explanationOfChange, image, typeOfChange, valueOfChange, objectOfChange))
+        if getattr(self.parent, "UpdateHistoryMemory", None):
+            self.parent.UpdateHistoryMemory()
 
     def duplicateCurrentLayer(self):
-        if self.currentLayer in self.layerHistory:
-            history = self.layerHistory[self.currentLayer]
-            if len(history) > 0:
-                latest = history[-1]
-
-                # Create a new layer with latest as the starting point
-                self.currentLayer = self.numLayersCreated
-                self.numLayersCreated += 1
-                self.layerHistory[self.currentLayer] = []
-                self.addToHistory(latest["pixmap"], "Open", None, None, None)
-
-    def setImage(self, image, addToHistory=True, explanationOfChange="", typeOfChange=None, valueOfChange=None, objectOfChange=None):
+        history = self.getCurrentLayerHistory()
+        if history:
+            latest = history[-1]
+
+            # Create a new layer with latest as the starting point
+            self.currentLayer = self.numLayersCreated
+            self.numLayersCreated += 1
+            self.layerHistory[self.currentLayer] = LayerHistory()
+            self.addToHistory(latest.image, "Open", None, None, None)
+
+    def setImage(self, image, addToHistory=True, explanationOfChange="", typeOfChange=None, valueOfChange=None, objectOfChange=None, historyImage=None, base=None, replay=None):
         """ Set the scene's current image pixmap to the input QImage or QPixmap.
         Raises a RuntimeError if the input image has type other than QImage or QPixmap.
+        historyImage is the HistoryImage image was read from, if any; undo adds it back as is.
+        base and replay let the history render image again instead of storing it, see
+        HistoryStore.add().
         :type image: QImage | QPixmap
         """
         if type(image) is QPixmap:
@@ -415,111 +436,180 @@ class QtImageViewer(QGraphicsView):
             if self.layerListDock:
                 # Update the layer button pixmap to the new 
                 self.layerListDock.setButtonPixmap(pixmap)
-            self.addToHistory(pixmap.copy(), explanationOfChange, typeOfChange, valueOfChange, objectOfChange)
-        
-        ##########################################################################################
-        # Grid for transparent images
-        #########################################################################################
-
-        # https://stackoverflow.com/a/67073067
-        def checkerboard(w, h):
-            from itertools import chain
-            from math import ceil
-            from PIL import Image
-
-            m, n = (int(w / 100), int(h / 100))             # Checker dimension (x, y)
-
-            if m < 100:
-                if m == 0:
-                    m = 1
-                m *= 100/m
-                m = int(m)
-                n = int(m * h / w)
-            elif n < 100:
-                if n == 0:
-                    n = 1
-                n *= 100/n 
-                n = int(n)
-                m = int(n * w / h)
-
-            c1 = (225, 255, 255, 0)                  # First color
-            c2 = (83, 83, 83)                        # Second color
-            mode = 'L' if isinstance(c1, int) else 'RGBA'   # Mode from first color
-
-            # Generate pixel-wise checker, even x dimension
-            if m % 2 == 0:
-                pixels = [[c1, c2] for i in range(int(m/2))] + \
-                         [[c2, c1] for i in range(int(m/2))]
-                pixels = [list(chain(*pixels)) for i in range(ceil(n/2))]
-
-            # Generate pixel-wise checker, odd x dimension
-            else:
-                pixels = [[c1, c2] for i in range(ceil(m*n/2))]
-
-            # Generate final Pillow-compatible pixel values
-            pixels = list(chain(*pixels))[:(m*n)]
-
-            # Generate Pillow image from pixel values, resize to final image size, and save
-            checker = Image.new(mode, (m, n))
-            checker.putdata(pixels)
-            checker = checker.resize((w, h), Image.NEAREST)
-            return checker
-
-        original = pixmap.copy()
-
-        width = pixmap.width()
-        height = pixmap.height()
-
-        if not self.checkerBoard:
-            self.checkerBoard = checkerboard(width, height)
-            self.checkerBoard = self.ImageToQPixmap(self.checkerBoard)
-        else:
-            if self.checkerBoardHeight != height or self.checkerBoardWidth != width:
-                self.checkerBoard = checkerboard(width, height)
-                self.checkerBoard = self.ImageToQPixmap(self.checkerBoard)
-        if self.checkerBoard:
-            painter = QPainter(pixmap)
-            painter.drawPixmap(QPoint(), self.checkerBoard)
-            painter.drawPixmap(QPoint(), original)
-            painter.end()
-
-        #########################################################################################
-        
+            if historyImage is None:
+                # Shared, not copied: QPixmap detaches on the first write, and nothing paints
+                # on the displayed pixmap
+                historyImage = self.historyStore.add(pixmap, base, replay)
+            self.addToHistory(historyImage, explanationOfChange, typeOfChange, valueOfChange, objectOfChange)
+        self._imageStats = None if historyImage is None else historyImage.stats
+        if historyImage is not None:
+            # Previews and overlays keep the grid of the image they show
+            self._hasAlpha = historyImage.hasAlpha
+
+        # The pixmap is shown as is, drawBackground() puts the transparency grid under it
+        # Only the tiles whose hashes changed are uploaded again
+        digests = None if historyImage is None else historyImage.digests
         if self.hasImage():
-            self._image.setPixmap(pixmap)
+            self._image.setPixmap(pixmap, digests)
         else:
-            self._image = self.scene.addPixmap(pixmap)
+            self._image = QTiledImageItem(pixmap, digests)
+            self.scene.addItem(self._image)
 
-        # Better quality pixmap scaling?
-        # !!! This will distort actual pixel data when zoomed way in.
-        #     For scientific image analysis, you probably don't want this.
-        # self._pixmap.setTransformationMode(Qt.SmoothTransformation)
+        # Undo any proxy preview scaling
+        self._isShowingPreview = False
+        self._image.setTransform(QtGui.QTransform())
+        self._image.setTransformationMode(Qt.TransformationMode.FastTransformation)
 
         self.setSceneRect(QRectF(pixmap.rect()))  # Set scene size to image size.
         self.updateViewer()
         if getattr(self.parent, "UpdateHistogramPlot", None):
             self.parent.UpdateHistogramPlot()
 
+    def checkerBrush(self):
+        """ Tiled brush of the transparency grid, in scene (image pixel) coordinates.
+        Cells are a hundredth of the image width, 100 pixels at most, like the original grid.
+        :rtype: QBrush
+        """
+        size = max(1, min(100, int(self.sceneRect().width()) // 100))
+        if self._checkerBrush is None or self._checkerSize != size:
+            tile = QPixmap(2 * size, 2 * size)
+            tile.fill(Qt.GlobalColor.transparent)
+            painter = QPainter(tile)
+            painter.fillRect(size, 0, size, size, QColor(83, 83, 83))
+            painter.fillRect(0, size, size, size, QColor(83, 83, 83))
+            painter.end()
+            self._checkerBrush = QBrush(tile)
+            self._checkerSize = size
+        return self._checkerBrush
+
+    def drawBackground(self, painter, rect):
+        """ Draws the transparency grid under the image, only if it has transparent pixels.
+        """
+        QGraphicsView.drawBackground(self, painter, rect)
+        if self._hasAlpha and self.hasImage():
+            painter.fillRect(rect.intersected(self.sceneRect()), self.checkerBrush())
+
+    def setPreviewImage(self, pixmap):
+        """ Show a downscaled render stretched over the current image.
+        Neither the history nor the scene size is touched, the next setImage() replaces it.
+        """
+        if not self.hasImage():
+            return
+        sceneRect = self.sceneRect()
+        self._image.setPixmap(pixmap)
+        self._image.setTransform(QtGui.QTransform.fromScale(sceneRect.width() / pixmap.width(), sceneRect.height() / pixmap.height()))
+        self._image.setTransformationMode(Qt.TransformationMode.SmoothTransformation)
+        self._isShowingPreview = True
+
+    def isShowingPreview(self):
+        return self._isShowingPreview
     
     def open(self, filepath=None):
         """ Load an image from file.
         Without any arguments, loadImageFromFile() will pop up a file dialog to choose the image file.
         With a fileName argument, loadImageFromFile(fileName) will attempt to load the specified image file directly.
+        The image is decoded on a worker thread, imageOpened is emitted once it is in the history.
         """
         if filepath is None:
             filepath, dummy = QFileDialog.getOpenFileName(self, "Open image file.")
         if len(filepath) and os.path.isfile(filepath):
-            self._current_filename = filepath
-            image = QImage(filepath)
-            self.setImage(image, True, "Open")
+            self._openingFilename = filepath
+            self.imageOpening.emit()
+            start = time.perf_counter()
+
+            self._openStart = start
+            self._openFirstPixel = None
+
+            # A screen sized decode is shown while the full image decodes, if the format has
+            # a fast one. Otherwise a slower preview is queued on the pool first, if any.
+            ratio = self.devicePixelRatioF()
+            preview = readPreview(filepath, self.viewport().width() * ratio, self.viewport().height() * ratio)
+            if preview is None:
+                self.previewQueue.submit(lambda isCancelled: readWorkerPreview(filepath))
+            else:
+                self.previewQueue.cancel()
+
+            # The full image is decoded and counted on a worker, see onOpenCompleted()
+            self.openQueue.submit(lambda isCancelled: readImage(filepath))
+
+            if preview is not None:
+                self.showOpenPreview(*preview)
+                self.viewport().repaint()
+                self._openFirstPixel = time.perf_counter() - start
+
+    def showOpenPreview(self, image, size):
+        """ Shows a reduced size decode of an image of the given full size until the full
+        image is decoded. The scene already has the full size, so the view does not jump.
+        """
+        self.setImage(image, False)
+        self._hasAlpha = image.hasAlphaChannel()
+        self.setSceneRect(QRectF(0, 0, size.width(), size.height()))
+        self.setPreviewImage(self.pixmap())
+        self.updateViewer()
+
+    def isOpening(self):
+        """ Returns whether a file is being decoded. The preview on screen is not in the
+        history then, and the history and the current file are still the previous image's.
+        """
+        return self._openingFilename is not None
+
+    def restoreView(self):
+        """ Shows the latest history entry of the current layer again, or nothing.
+        """
+        image = self.getCurrentLayerLatestImage()
+        if image is not None:
+            self.setImage(image.pixmap(), False, historyImage=image)
+        else:
+            self.clearImage()
+            self.setSceneRect(QRectF())
+            self.viewport().update()
+
+    @QtCore.pyqtSlot(int, object, float)
+    def onOpenPreviewCompleted(self, generation, result, seconds):
+        # Cancelled as soon as the open completes or fails, the full image is never replaced
+        self.showOpenPreview(*result)
+        if self._openFirstPixel is None:
+            self._openFirstPixel = time.perf_counter() - self._openStart
+
+    @QtCore.pyqtSlot(int, object, float)
+    def onOpenCompleted(self, generation, result, seconds):
+        self.previewQueue.cancel()
+        image, histograms = result
+        if image.isNull():
+            self.onOpenFailed(generation, "")
+            return
+        self._current_filename = self._openingFilename
+        self._openingFilename = None
+        pixmap = QPixmap.fromImage(image)
+
+        # Counted on the worker, the histogram plot needs no pass over the image
+        historyImage = self.historyStore.add(pixmap)
+        historyImage.stats.setHistograms(histograms)
+        self.setImage(pixmap, True, "Open", historyImage=historyImage)
+
+        seconds = time.perf_counter() - self._openStart
+        self.imageOpened.emit(seconds if self._openFirstPixel is None else self._openFirstPixel, seconds)
+
+    @QtCore.pyqtSlot(int, str)
+    def onOpenFailed(self, generation, message):
+        # The preview goes, the previous image stays current
+        self.previewQueue.cancel()
+        filepath = self._openingFilename
+        self._openingFilename = None
+        self.restoreView()
+        self.imageOpenFailed.emit(filepath)
 
     def save(self, filepath=None):
+        # The stored image, never what the view composites for display or an open preview
+        pixmap = self.getCurrentLayerLatestPixmap()
+        if self.isOpening() or not pixmap:
+            return
+
         path = self._current_filename
         if filepath:
             path = filepath
             self._current_filename = path
-
-        self.pixmap().save(path, None, 100)
+        pixmap.save(path, None, 100)
 
     def updateViewer(self):
         """ Show current zoom (if showing entire image, apply current aspect ratio mode).
@@ -542,27 +632,6 @@ class QtImageViewer(QGraphicsView):
         """
         self.updateViewer()
 
-    def QPixmapToImage(self, pixmap):
-        width = pixmap.width()
-        height = pixmap.height()
-        image = pixmap.toImage()
-
-        byteCount = image.bytesPerLine() * height
-        data = image.constBits().asstring(byteCount)
-        return Image.frombuffer('RGBA', (width, height), data, 'raw', 'BGRA', 0, 1)
-
-    def QImageToImage(self, qimage):
-        width = qimage.width()
-        height = qimage.height()
-        image = qimage
-
-        byteCount = image.bytesPerLine() * height
-        data = image.constBits().asstring(byteCount)
-        return Image.frombuffer('RGBA', (width, height), data, 'raw', 'BGRA', 0, 1)
-
-    def ImageToQPixmap(self, image):
-        return QPixmap.fromImage(ImageQt(image))
-
     def mousePressEvent(self, event):
         """ Start mouse pan or zoom mode.
         """
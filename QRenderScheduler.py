@@ -0,0 +1,97 @@
+""" QRenderScheduler.py: Coalesces slider changes into as few renders as the pipeline can keep up with.
+
+A change that arrives while the render pipeline is idle is rendered immediately. Changes
+that arrive while a render is running are folded into a single pending render, which
+starts as soon as the running one finishes. Render times and slider-to-pixel latencies
+of recent renders are recorded so the pipeline can be tuned.
+"""
+
+import collections
+import time
+
+from PyQt6 import QtCore
+
+
+class QRenderScheduler(QtCore.QObject):
+
+    # Slider-to-pixel latency and render time of the latest presented render, in seconds
+    latencySignal = QtCore.pyqtSignal(float, float)
+
+    def __init__(self, renderQueue, submit, history=20, parent=None):
+        super(QRenderScheduler, self).__init__(parent)
+        self.renderQueue = renderQueue
+        self.renderQueue.finishedSignal.connect(self.onFinished)
+
+        # Submits a render of the latest state to renderQueue, returns its generation or None
+        self.submit = submit
+
+        # Generation in flight and whether changes arrived since it was submitted
+        self.running = None
+        self.pending = False
+
+        # Time of the oldest change not submitted yet, and of the changes each generation covers
+        self._requestTime = None
+        self._submittedRequestTimes = {}
+
+        # Recent measurements in seconds
+        self.renderTimes = collections.deque(maxlen=history)
+        self.latencies = collections.deque(maxlen=history)
+
+    def request(self, urgent=False):
+        """ Schedules a render of the latest state.
+        An urgent request does not wait for the running render, which goes stale. """
+        if self._requestTime is None:
+            self._requestTime = time.perf_counter()
+
+        if self.running is None or urgent:
+            self.fire()
+        else:
+            self.pending = True
+
+    def fire(self):
+        self.pending = False
+        generation = self.submit()
+        if generation is None:
+            self._requestTime = None
+            return
+        self.running = generation
+
+        # Earlier generations went stale, they will never be presented
+        self._submittedRequestTimes = {generation: self._requestTime}
+        self._requestTime = None
+
+    def cancel(self):
+        """ Discards the running and the pending render, neither of them is presented """
+        self.renderQueue.cancel()
+        self.running = None
+        self.pending = False
+        self._requestTime = None
+        self._submittedRequestTimes = {}
+
+    @QtCore.pyqtSlot(int)
+    def onFinished(self, generation):
+        if generation != self.running:
+            return
+        self.running = None
+        if self.pending:
+            self.fire()
+
+    def presented(self, generation, renderSeconds):
+        """ Call once the result of generation is on screen """
+        requestTime = self._submittedRequestTimes.pop(generation, None)
+        if requestTime is None:
+            return
+        latency = time.perf_counter() - requestTime
+        self.renderTimes.append(renderSeconds)
+        self.latencies.append(latency)
+        self.latencySignal.emit(latency, renderSeconds)
+
+    def averageRenderTime(self):
+        if not self.renderTimes:
+            return None
+        return sum(self.renderTimes) / len(self.renderTimes)
+
+    def averageLatency(self):
+        if not self.latencies:
+            return None
+        return sum(self.latencies) / len(self.latencies)
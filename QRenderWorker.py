@@ -0,0 +1,125 @@
+""" QRenderWorker.py: Runs slider renders on a QThreadPool and drops stale results.
+
+Every submitted render gets the next generation number. Submitting a newer render takes
+the previous one off the pool queue if it has not started yet, running renders notice
+they went stale between engine passes and stop, and only a result of the latest
+generation is relayed to the GUI thread.
+
+An exception escaping a QRunnable aborts the process, so a render that raises is reported
+through failedSignal instead, with the traceback printed.
+"""
+
+import time
+import traceback
+
+from PyQt6 import QtCore
+
+
+class QRenderSignals(QtCore.QObject):
+    # Generation, rendered buffer and render time in seconds
+    completedSignal = QtCore.pyqtSignal(int, object, float)
+
+    # Generation and error message of a render that raised
+    failedSignal = QtCore.pyqtSignal(int, str)
+
+    # Generation of a job that stopped running, whether it produced a result or not
+    finishedSignal = QtCore.pyqtSignal(int)
+
+
+class QRenderJob(QtCore.QRunnable):
+
+    def __init__(self, generation, render, isCurrent, signals):
+        super(QRenderJob, self).__init__()
+        # Python keeps the job alive until it is done, see QRenderQueue.submit()
+        self.setAutoDelete(False)
+
+        self.generation = generation
+        self.render = render
+        self.isCurrent = isCurrent
+        self.signals = signals
+        self.done = False
+
+    def isCancelled(self):
+        return not self.isCurrent(self.generation)
+
+    def run(self):
+        try:
+            if self.isCancelled():
+                return
+            start = time.perf_counter()
+            buffer = self.render(self.isCancelled)
+            if buffer is None or self.isCancelled():
+                return
+            self.signals.completedSignal.emit(self.generation, buffer, time.perf_counter() - start)
+        except Exception as error:
+            traceback.print_exc()
+            self.signals.failedSignal.emit(self.generation, str(error) or type(error).__name__)
+        finally:
+            self.done = True
+            self.signals.finishedSignal.emit(self.generation)
+
+
+class QRenderQueue(QtCore.QObject):
+
+    # Generation, rendered buffer and render time in seconds, latest generation only
+    completedSignal = QtCore.pyqtSignal(int, object, float)
+
+    # Generation and error message of a render that raised, latest generation only
+    failedSignal = QtCore.pyqtSignal(int, str)
+
+    # Generation of a finished job, latest generation only
+    finishedSignal = QtCore.pyqtSignal(int)
+
+    def __init__(self, threadpool, workers, parent=None):
+        super(QRenderQueue, self).__init__(parent)
+        self.threadpool = threadpool
+
+        # Jobs that may still be queued or running
+        self.workers = workers
+
+        self.generation = 0
+        self.signals = QRenderSignals()
+        self.signals.completedSignal.connect(self.onCompleted)
+        self.signals.failedSignal.connect(self.onFailed)
+        self.signals.finishedSignal.connect(self.onFinished)
+
+    def isCurrent(self, generation):
+        return generation == self.generation
+
+    def isBusy(self):
+        return any(not job.done for job in self.workers)
+
+    def submit(self, render):
+        """ Runs render(isCancelled) on the pool, it returns a buffer or None if cancelled.
+        Returns the generation number of the new render. """
+        self.generation += 1
+
+        # Drop renders that did not start yet, forget the finished ones
+        for job in self.workers:
+            if not job.done and self.threadpool.tryTake(job):
+                job.done = True
+        self.workers[:] = [job for job in self.workers if not job.done]
+
+        job = QRenderJob(self.generation, render, self.isCurrent, self.signals)
+        self.workers.append(job)
+        self.threadpool.start(job)
+        return self.generation
+
+    def cancel(self):
+        """ Discards every queued and running render """
+        self.generation += 1
+
+    @QtCore.pyqtSlot(int, object, float)
+    def onCompleted(self, generation, buffer, seconds):
+        if self.isCurrent(generation):
+            self.completedSignal.emit(generation, buffer, seconds)
+
+    @QtCore.pyqtSlot(int, str)
+    def onFailed(self, generation, message):
+        if self.isCurrent(generation):
+            self.failedSignal.emit(generation, message)
+
+    @QtCore.pyqtSlot(int)
+    def onFinished(self, generation):
+        if self.isCurrent(generation):
+            self.finishedSignal.emit(generation)
@@ -0,0 +1,236 @@
+""" QTiledImageItem.py: Shows an image as the tiles of a multi-resolution pyramid.
+
+A QGraphicsPixmapItem uploads the whole frame on every change and draws it from full
+resolution at every zoom, which is slow for scans of hundreds of megapixels. This item
+cuts the image into the tiles of the history (TILE_SIZE, see HistoryStore) at several
+levels of detail: level 0 is the image, every further level has half the width and
+height of the one before. A paint draws the level matching the zoom, and only the tiles
+of that level which intersect the exposed area are turned into pixmaps. Tile pixmaps are
+kept in a least recently used cache.
+
+The levels are a mipmap: every pixel of a level is the average of four pixels of the
+level below, computed when a tile of the level is first needed. The pixels of the levels
+count against the budget of the tile cache and are dropped before any tile pixmap; a
+dropped tile is averaged again from the level below when it is needed. Zoomed out, a
+paint samples the nearest level at least as detailed as the screen with smooth
+(bilinear) scaling, so it never filters more than two pixels of the level into one
+device pixel, and zooming and panning never rescale the full frame. Zoomed in, pixels
+are drawn as they are.
+
+An edit passes the tile hashes of the new image along with it. Tiles whose hash did not
+change keep their pixmaps, at every level, so an edit only uploads the tiles it touched.
+
+The item stands in for a QGraphicsPixmapItem: pixmap(), setPixmap() and
+setTransformationMode() work the same.
+"""
+
+import collections
+import math
+
+import cv2
+import numpy as np
+from PyQt6 import QtCore, QtGui, QtWidgets
+
+from HistoryStore import TILE_SIZE
+from QImageBridge import ArrayToQImage, QImageMemory
+
+Format = QtGui.QImage.Format
+
+# Bytes of tile pixmaps and mipmap pixels kept at most
+TILE_BUDGET = 256 * 1024 * 1024
+
+# 32 bit formats the tiles are cut from as they are, other images are converted once
+TILE_FORMATS = (Format.Format_RGB32, Format.Format_ARGB32, Format.Format_ARGB32_Premultiplied)
+
+
+def halve(pixels):
+    """ Averages every 2 x 2 block of a (height, width, 4) uint8 array, rounded. An odd last
+    row or column is averaged with itself. """
+    height, width = pixels.shape[:2]
+    if height % 2 or width % 2:
+        pixels = np.pad(pixels, ((0, height % 2), (0, width % 2), (0, 0)), mode="edge")
+    # An area resize by exactly one half is the 2 x 2 box average
+    return cv2.resize(pixels, (pixels.shape[1] // 2, pixels.shape[0] // 2), interpolation=cv2.INTER_AREA)
+
+
+class QTiledImageItem(QtWidgets.QGraphicsItem):
+
+    def __init__(self, pixmap=None, digests=None, parent=None):
+        super(QTiledImageItem, self).__init__(parent)
+        # Paints get the exposed rect instead of the whole item
+        self.setFlag(QtWidgets.QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+
+        self._pixmap = QtGui.QPixmap()
+        self._transformationMode = QtCore.Qt.TransformationMode.FastTransformation
+
+        # Raw pixels of the image, a read-only view of its memory, and its format
+        self._pixels = None
+        self._format = None
+
+        # (width, height) of every level and the hash of every level 0 tile, or None
+        self._levels = []
+        self._digests = None
+
+        # (level, row, column) -> QPixmap, least recently used first
+        self._tiles = collections.OrderedDict()
+        self._tileBytes = 0
+
+        # (level, row, column) -> pixels of the mipmap levels above 0, least recently used
+        # first; the pixmaps of their tiles share this memory where the format allows it
+        self._mipmaps = collections.OrderedDict()
+        self._mipmapBytes = 0
+
+        if pixmap is not None:
+            self.setPixmap(pixmap, digests)
+
+    def pixmap(self):
+        return self._pixmap
+
+    def setPixmap(self, pixmap, digests=None):
+        """ Shows pixmap. digests are the hashes of its tiles in HistoryStore.tileSlices()
+        order, if known; tiles with the same hash as before are not uploaded again. """
+        previous = self._digests
+        if pixmap.size() != self._pixmap.size():
+            self.prepareGeometryChange()
+            previous = None
+
+        self._pixmap = pixmap
+        image = pixmap.toImage()
+        if image.format() not in TILE_FORMATS:
+            image = image.convertToFormat(Format.Format_ARGB32_Premultiplied)
+        self._format = image.format()
+        self._pixels = np.asarray(QImageMemory(image, False)) if not image.isNull() else None
+
+        width, height = pixmap.width(), pixmap.height()
+        self._levels = [(width, height)]
+        while width > TILE_SIZE or height > TILE_SIZE:
+            width, height = (width + 1) // 2, (height + 1) // 2
+            self._levels.append((width, height))
+
+        self._digests = digests
+        if previous is None or digests is None or len(previous) != len(digests):
+            self.invalidate()
+        else:
+            columns = math.ceil(pixmap.width() / TILE_SIZE)
+            changed = [divmod(index, columns) for index, (old, new) in enumerate(zip(previous, digests)) if old != new]
+            self.invalidate(changed)
+        self.update()
+
+    def invalidate(self, tiles=None):
+        """ Drops the pixmaps of the given (row, column) level 0 tiles and of the tiles above
+        them at every level, or of all tiles """
+        if tiles is None:
+            self._tiles.clear()
+            self._tileBytes = 0
+            self._mipmaps.clear()
+            self._mipmapBytes = 0
+            return
+        for level in range(len(self._levels)):
+            for row, column in set((row >> level, column >> level) for row, column in tiles):
+                pixels = self._mipmaps.pop((level, row, column), None)
+                if pixels is not None:
+                    self._mipmapBytes -= pixels.nbytes
+                tile = self._tiles.pop((level, row, column), None)
+                if tile is not None:
+                    self._tileBytes -= tile.width() * tile.height() * 4
+
+    def setTransformationMode(self, mode):
+        if mode != self._transformationMode:
+            self._transformationMode = mode
+            self.update()
+
+    def transformationMode(self):
+        return self._transformationMode
+
+    def levelCount(self):
+        return len(self._levels)
+
+    def levelFor(self, levelOfDetail):
+        """ The coarsest level with at least one pixel for every device pixel at the given
+        level of detail (device pixels per image pixel) """
+        if levelOfDetail <= 0:
+            return len(self._levels) - 1
+        if levelOfDetail >= 1:
+            return 0
+        return min(int(math.floor(math.log2(1 / levelOfDetail))), len(self._levels) - 1)
+
+    def tile(self, level, row, column):
+        """ The pixmap of one tile of a level, made and cached on first use """
+        key = (level, row, column)
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            return tile
+
+        pixels = np.ascontiguousarray(self.tilePixels(level, row, column))
+        tile = QtGui.QPixmap.fromImage(ArrayToQImage(pixels, format=self._format))
+
+        self._tiles[key] = tile
+        self._tileBytes += tile.width() * tile.height() * 4
+        self.trim()
+        return tile
+
+    def trim(self):
+        """ Drops least recently used mipmap pixels, then tile pixmaps, until they fit the
+        budget. The latest tile pixmap stays. """
+        while self._tileBytes + self._mipmapBytes > TILE_BUDGET and self._mipmaps:
+            _, evicted = self._mipmaps.popitem(last=False)
+            self._mipmapBytes -= evicted.nbytes
+        while self._tileBytes > TILE_BUDGET and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self._tileBytes -= evicted.width() * evicted.height() * 4
+
+    def tilePixels(self, level, row, column):
+        """ The pixels of one tile of a level: a view of the image at level 0, the average of
+        the four tiles below it otherwise """
+        if level == 0:
+            top = row * TILE_SIZE
+            left = column * TILE_SIZE
+            return self._pixels[top:top + TILE_SIZE, left:left + TILE_SIZE]
+
+        key = (level, row, column)
+        pixels = self._mipmaps.get(key)
+        if pixels is not None:
+            self._mipmaps.move_to_end(key)
+        else:
+            width, height = self._levels[level - 1]
+            rows = range(2 * row, min(2 * row + 2, math.ceil(height / TILE_SIZE)))
+            columns = range(2 * column, min(2 * column + 2, math.ceil(width / TILE_SIZE)))
+            below = np.concatenate([np.concatenate([self.tilePixels(level - 1, r, c) for c in columns], axis=1) for r in rows])
+            pixels = halve(below)
+            pixels.flags.writeable = False
+            self._mipmaps[key] = pixels
+            self._mipmapBytes += pixels.nbytes
+            self.trim()
+        return pixels
+
+    def boundingRect(self):
+        return QtCore.QRectF(0, 0, self._pixmap.width(), self._pixmap.height())
+
+    def paint(self, painter, option, widget=None):
+        if self._pixels is None:
+            return
+        levelOfDetail = option.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.levelFor(levelOfDetail)
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        if exposed.isEmpty():
+            return
+
+        # Image pixels per pixel of the level
+        width, height = self._levels[level]
+        scaleX = self._pixmap.width() / width
+        scaleY = self._pixmap.height() / height
+        extent = TILE_SIZE * scaleX, TILE_SIZE * scaleY
+        firstColumn = int(exposed.left() // extent[0])
+        lastColumn = min(int(math.ceil(exposed.right() / extent[0])), math.ceil(width / TILE_SIZE))
+        firstRow = int(exposed.top() // extent[1])
+        lastRow = min(int(math.ceil(exposed.bottom() / extent[1])), math.ceil(height / TILE_SIZE))
+
+        # Zoomed out the level is filtered down by less than two, zoomed in pixels stay sharp
+        smooth = levelOfDetail < 1 or self._transformationMode == QtCore.Qt.TransformationMode.SmoothTransformation
+        painter.setRenderHint(QtGui.QPainter.RenderHint.SmoothPixmapTransform, smooth)
+        for row in range(firstRow, lastRow):
+            for column in range(firstColumn, lastColumn):
+                tile = self.tile(level, row, column)
+                target = QtCore.QRectF(column * extent[0], row * extent[1], tile.width() * scaleX, tile.height() * scaleY)
+                painter.drawPixmap(target, tile, QtCore.QRectF(tile.rect()))
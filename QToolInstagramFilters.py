@@ -1,15 +1,47 @@
+import functools
+
 from PyQt6.QtWidgets import QWidget, QToolButton, QHBoxLayout, QScrollArea
 from PyQt6.QtGui import QIcon
 from PyQt6.QtCore import QSize
 from PyQt6 import QtCore
 from QFlowLayout import QFlowLayout
+from QImageBridge import ArrayToImage, ArrayToQPixmap, ImageToArray, ImageToQPixmap
+from ScratchDisk import defaultScratchDisk
+
+def filterImage(image, filterName):
+    """ Applies the pilgram filter of that name to a PIL image, "unfiltered" applies none """
+    if filterName == "unfiltered":
+        return image
+    import pilgram
+    return getattr(pilgram, filterName)(image).convert("RGBA")
+
+def filterOutput(image):
+    """ Copies a filtered PIL image into a new BGRA buffer, on the scratch disk once RAM runs short """
+    return ImageToArray(image, out=defaultScratchDisk.allocate((image.height, image.width, 4)))
+
+def replayFilter(buffer, filterName, mask=None):
+    """ Renders a filter selection again from a writable BGRA copy of the tool source """
+    output = filterOutput(filterImage(ArrayToImage(buffer if mask is None else mask.crop(buffer)), filterName))
+    if mask is None:
+        return output
+    return mask.composite(buffer, output, out=buffer)
 
 class QToolInstagramFilters(QScrollArea):
-    def __init__(self, parent=None, toolInput=None):
+    def __init__(self, parent=None, toolInput=None, source=None, mask=None, base=None):
         super(QToolInstagramFilters, self).__init__(None)
         self.parent = parent
         self.toolInput = toolInput
+
+        # With a selection toolInput is its bounding box, filtered results are blended
+        # back into the BGRA source buffer through the SelectionMask
+        self.source = source
+        self.mask = mask
         self.output = None
+
+        # HistoryImage of the source, the selected filter and its result
+        self.base = base
+        self.filterName = None
+        self.pixmap = None
         self.layout = QHBoxLayout()
         self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
         self.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
@@ -87,7 +119,7 @@ class QToolInstagramFilters(QScrollArea):
         buttonIconSize = QSize(200, 200)
 
         noFilterButton = QToolButton()
-        unfilteredPixmap = self.parent.ImageToQPixmap(image)
+        unfilteredPixmap = ImageToQPixmap(image)
         unfilteredPixmap = unfilteredPixmap.scaled(buttonIconSize, QtCore.Qt.AspectRatioMode.KeepAspectRatio, QtCore.Qt.TransformationMode.SmoothTransformation)
         icon = QIcon(unfilteredPixmap)
         noFilterButton.setIcon(icon)
@@ -101,7 +133,7 @@ class QToolInstagramFilters(QScrollArea):
         for i, f in enumerate(filters):
             filterButton = QToolButton()
             filtered = f(image).convert("RGBA")
-            filteredPixmap = self.parent.ImageToQPixmap(filtered)
+            filteredPixmap = ImageToQPixmap(filtered)
             filteredPixmap = filteredPixmap.scaled(buttonIconSize, QtCore.Qt.AspectRatioMode.KeepAspectRatio, QtCore.Qt.TransformationMode.SmoothTransformation)
 
             icon = QIcon(filteredPixmap)
@@ -116,15 +148,18 @@ class QToolInstagramFilters(QScrollArea):
         self.output = None 
 
     def OnFilterSelect(self):
-        import pilgram
         button = self.sender()
-        filterName = button.objectName()
-        if filterName != "unfiltered":
-            filterFunction = getattr(pilgram, filterName)
-            self.output = filterFunction(self.toolInput).convert("RGBA")
+        self.filterName = button.objectName()
+        self.output = filterImage(self.toolInput, self.filterName)
+        if self.mask is None:
+            self.pixmap = ArrayToQPixmap(filterOutput(self.output))
         else:
-            self.output = self.toolInput
-        self.parent.image_viewer.setImage(self.parent.ImageToQPixmap(self.output), False)
+            self.pixmap = ArrayToQPixmap(self.mask.composite(self.source, filterOutput(self.output)))
+        self.parent.image_viewer.setImage(self.pixmap, False)
+
+    def replay(self):
+        """ Function the history renders the selected filter again with, see HistoryStore """
+        return functools.partial(replayFilter, filterName=self.filterName, mask=self.mask)
 
     def closeEvent(self, event):
         self.destroyed.emit()
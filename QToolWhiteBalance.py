@@ -13,15 +13,12 @@ class QToolWhiteBalance(QTool):
 
     def onRun(self, progressSignal, args):
         # https://github.com/mahmoudnafifi/WB_sRGB
-        import cv2
         import WhiteBalance
-        import numpy as np
-        from PIL import Image
+        from ScratchDisk import defaultScratchDisk
 
         progressSignal.emit(10, "Loading current pixmap")
+        # BGRA buffer of the current pixmap
         image = args[0]
-        image_ndarray = np.asarray(image)
-        b, g, r, a = cv2.split(image_ndarray)
 
         # use gamut_mapping = 1 for scaling, 2 for clipping (our paper's results
         # reported using clipping). If the image is over-saturated, scaling is
@@ -30,8 +27,10 @@ class QToolWhiteBalance(QTool):
 
         wbModel = WhiteBalance.WBsRGB(gamut_mapping=gamut_mapping)
 
-        self.output = wbModel.correctImage(np.dstack((r, g, b)))
-        self.output = (self.output * 255).astype(np.uint8)
-        b, g, r = cv2.split(self.output)
-        self.output = np.dstack((r, g, b, a))
-        self.output = Image.fromarray(self.output)
\ No newline at end of file
+        # The model takes and returns BGR images, scaled to 0..1
+        corrected = wbModel.correctImage(image[..., :3])
+        corrected *= 255
+        output = defaultScratchDisk.allocate(image.shape)
+        output[..., :3] = corrected
+        output[..., 3] = image[..., 3]
+        self.output = output
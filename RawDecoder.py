@@ -0,0 +1,185 @@
+""" RawDecoder.py: Opens camera RAW files with rawpy (LibRaw).
+
+A full demosaic takes seconds, so a RAW opens in two steps like any other image (see
+ImageLoader): readRawPreview() shows the JPEG the camera embedded in the file, decoded at
+screen size, and decodeRaw() runs the full demosaic on a worker thread. A file without
+an embedded JPEG shows decodeRawPreview() instead, a half size demosaic that takes a
+fraction of the full one; it runs on a worker thread too, ahead of the full decode.
+
+Decoded images are kept in a RawCache on disk, keyed by the path, size and modification
+time of the file and the decode parameters. Reopening a RAW memory maps the cached
+pixels instead of demosaicing again. The cache lives in IMAGE_EDITOR_RAW_CACHE_DIR, or
+~/.cache/ImageEditor/raw, and drops the least recently used images beyond its budget.
+
+Without rawpy installed RAW files do not open, everything else works as before.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+from PyQt6 import QtCore, QtGui
+
+from QImageBridge import ArrayToQImage
+from ScratchDisk import defaultScratchDisk
+from StreamDecoder import convertPixels
+
+try:
+    import rawpy
+except ImportError:
+    rawpy = None
+
+RAW_EXTENSIONS = (".3fr", ".arw", ".cr2", ".cr3", ".crw", ".dng", ".erf", ".kdc", ".mef", ".mos", ".mrw",
+                  ".nef", ".nrw", ".orf", ".pef", ".raf", ".raw", ".rw2", ".rwl", ".sr2", ".srf", ".srw", ".x3f")
+
+# rawpy.postprocess() arguments of the full decode, part of the cache key
+DECODE_PARAMETERS = {"use_camera_wb": True, "output_bps": 8}
+
+# Bytes of decoded images kept on disk at most
+DEFAULT_CACHE_BUDGET = 4 * 1024 * 1024 * 1024
+
+# Clockwise rotation of the LibRaw flip values, the ones that mirror are not written by cameras
+FLIP_ROTATION = {3: 180, 5: 270, 6: 90}
+
+
+def isRaw(filepath):
+    return os.path.splitext(filepath)[1].lower() in RAW_EXTENSIONS
+
+
+class RawCache:
+
+    def __init__(self, directory=None, budget=DEFAULT_CACHE_BUDGET):
+        self.directory = directory or os.environ.get("IMAGE_EDITOR_RAW_CACHE_DIR") or \
+            os.path.join(os.path.expanduser("~"), ".cache", "ImageEditor", "raw")
+        self.budget = budget
+
+    def path(self, filepath, parameters):
+        """ Cache file of filepath decoded with parameters, changes whenever the file does """
+        stat = os.stat(filepath)
+        identity = repr((os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns, sorted(parameters.items())))
+        return os.path.join(self.directory, hashlib.sha256(identity.encode()).hexdigest() + ".npy")
+
+    def get(self, filepath, parameters):
+        """ The cached BGRA buffer, memory mapped copy on write, or None """
+        try:
+            path = self.path(filepath, parameters)
+            buffer = np.load(path, mmap_mode="c")
+            # Marks the image recently used
+            os.utime(path)
+            return buffer
+        except (OSError, ValueError):
+            return None
+
+    def put(self, filepath, parameters, buffer):
+        """ Stores buffer, quietly gives up if the cache directory cannot be written """
+        try:
+            path = self.path(filepath, parameters)
+            os.makedirs(self.directory, exist_ok=True)
+            temporary = path + "." + str(os.getpid()) + ".tmp"
+            with open(temporary, "wb") as file:
+                np.save(file, buffer)
+            os.replace(temporary, path)
+            self.trim()
+        except OSError:
+            pass
+
+    def trim(self):
+        """ Deletes the least recently used images until the rest fit the budget """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        used = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries)[:-1]:
+            if used <= self.budget:
+                break
+            os.remove(os.path.join(self.directory, name))
+            used -= size
+
+
+defaultRawCache = RawCache()
+
+
+def fullSize(raw):
+    """ QSize of the full decode of a rawpy.RawPy, with the camera rotation applied """
+    sizes = raw.sizes
+    if FLIP_ROTATION.get(sizes.flip) in (90, 270):
+        return QtCore.QSize(sizes.height, sizes.width)
+    return QtCore.QSize(sizes.width, sizes.height)
+
+
+def rgbToQImage(pixels):
+    """ Wraps a copy of (height, width, 3) RGB samples in a QImage """
+    buffer = np.empty(pixels.shape[:2] + (4,), dtype=np.uint8)
+    convertPixels(pixels, buffer)
+    return ArrayToQImage(buffer, format=QtGui.QImage.Format.Format_RGB32)
+
+
+def readRawPreview(filepath, width, height):
+    """ Returns (QImage fitting width x height, QSize of the full image) of a RAW file, or None
+    if its full decode is cached already, it has no embedded image or it cannot be read """
+    if rawpy is None or defaultRawCache.get(filepath, DECODE_PARAMETERS) is not None:
+        return None
+    try:
+        with rawpy.imread(filepath) as raw:
+            size = fullSize(raw)
+            # LibRawError if there is no embedded image
+            thumbnail = raw.extract_thumb()
+            if thumbnail.format == rawpy.ThumbFormat.JPEG:
+                # Decoded at screen size, like any other JPEG preview
+                data = QtCore.QBuffer()
+                data.setData(QtCore.QByteArray(thumbnail.data))
+                reader = QtGui.QImageReader(data)
+                thumbnailSize = reader.size()
+                if thumbnailSize.isValid() and (thumbnailSize.width() > width or thumbnailSize.height() > height):
+                    reader.setScaledSize(thumbnailSize.scaled(max(1, int(width)), max(1, int(height)), QtCore.Qt.AspectRatioMode.KeepAspectRatio))
+                image = reader.read()
+            else:
+                image = rgbToQImage(thumbnail.data)
+            # Thumbnails are stored the way the sensor is mounted
+            rotation = FLIP_ROTATION.get(raw.sizes.flip)
+    except (rawpy.LibRawError, OSError):
+        return None
+    if image.isNull():
+        return None
+    if rotation:
+        image = image.transformed(QtGui.QTransform().rotate(rotation))
+    return image, size
+
+
+def decodeRawPreview(filepath):
+    """ Returns (QImage of a half size demosaic, QSize of the full image) of a RAW file, or
+    None if its full decode is cached already or it cannot be read. Too slow for the GUI
+    thread, but much faster than decodeRaw(). """
+    if rawpy is None or defaultRawCache.get(filepath, DECODE_PARAMETERS) is not None:
+        return None
+    try:
+        with rawpy.imread(filepath) as raw:
+            size = fullSize(raw)
+            # Every 2x2 block of the sensor becomes one pixel, rotated like the full decode
+            pixels = raw.postprocess(half_size=True, **DECODE_PARAMETERS)
+    except (rawpy.LibRawError, OSError):
+        return None
+    return rgbToQImage(pixels), size
+
+
+def decodeRaw(filepath):
+    """ BGRA buffer of the full demosaic of a RAW file, from the cache if it was decoded
+    before, or None if it cannot be read """
+    buffer = defaultRawCache.get(filepath, DECODE_PARAMETERS)
+    if buffer is not None:
+        return buffer
+    if rawpy is None:
+        return None
+    try:
+        with rawpy.imread(filepath) as raw:
+            pixels = raw.postprocess(**DECODE_PARAMETERS)
+    except (rawpy.LibRawError, OSError):
+        return None
+
+    buffer = defaultScratchDisk.allocate(pixels.shape[:2] + (4,))
+    convertPixels(pixels, buffer)
+    del pixels
+    defaultRawCache.put(filepath, DECODE_PARAMETERS, buffer)
+    return buffer
@@ -0,0 +1,145 @@
+""" ScratchDisk.py: Spills large buffers to memory mapped files once RAM runs short.
+
+Once the resident memory of the editor crosses a threshold, compressed history tiles and
+cached render stages are written to memory mapped files in the scratch directory instead
+of being kept in RAM. Decoded images and the output buffers of edits are allocated there
+through allocate() and copy(), which the tools, the engines and the TileScheduler use
+for the buffers they return. The kernel faults the pages back in when they are read and
+writes them out again under memory pressure, so a panorama beyond RAM makes the editor
+slower instead of getting it killed.
+
+Scratch files are unlinked as soon as they are created, nothing is left behind after a
+crash. A file's space is returned once the last array or block in it is dropped.
+
+The directory and the threshold come from the environment variables
+IMAGE_EDITOR_SCRATCH_DIR and IMAGE_EDITOR_SCRATCH_THRESHOLD (in MB), or configure().
+They default to the system temporary directory and half of the physical memory.
+"""
+
+import mmap
+import os
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+# Blocks are appended to files of this size, larger ones get a file of their own
+ARENA_SIZE = 64 * 1024 * 1024
+
+
+def physicalMemory():
+    """ Bytes of physical memory, or None if the platform does not tell """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def residentMemory():
+    """ Bytes of RAM the process uses, or 0 if the platform does not tell """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        # Peak rather than current use, in kB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        return 0
+
+
+class Arena:
+
+    """ A memory mapped scratch file that blocks are appended to """
+
+    def __init__(self, directory, size):
+        with tempfile.TemporaryFile(dir=directory) as file:
+            file.truncate(size)
+            # The mapping keeps its own handle, the file is gone once it is unmapped
+            self.map = mmap.mmap(file.fileno(), size)
+        self.size = size
+        self.offset = 0
+
+
+class ScratchDisk:
+
+    def __init__(self, directory=None, threshold=None):
+        self._arena = None
+        self._lock = threading.Lock()
+
+        environmentThreshold = os.environ.get("IMAGE_EDITOR_SCRATCH_THRESHOLD")
+        if threshold is None and environmentThreshold:
+            threshold = int(environmentThreshold) * 1024 * 1024
+        self.configure(directory or os.environ.get("IMAGE_EDITOR_SCRATCH_DIR"), threshold)
+
+    def configure(self, directory=None, threshold=None):
+        """ Sets the scratch directory and the resident memory in bytes past which buffers spill """
+        self.directory = directory or tempfile.gettempdir()
+        if threshold is None:
+            memory = physicalMemory()
+            threshold = memory // 2 if memory else 8 * 1024 * 1024 * 1024
+        self.threshold = threshold
+        with self._lock:
+            self._arena = None
+
+    def isSpilling(self):
+        """ True while the editor uses more RAM than the threshold """
+        return residentMemory() > self.threshold
+
+    def empty(self, shape, dtype=np.uint8):
+        """ Uninitialized array backed by a scratch file of its own """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if nbytes == 0:
+            return np.empty(shape, dtype=dtype)
+        arena = Arena(self.directory, nbytes)
+        return np.frombuffer(arena.map, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+    def allocate(self, shape, dtype=np.uint8):
+        """ Uninitialized array, in a scratch file if it would take the editor past the threshold """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if residentMemory() + nbytes > self.threshold:
+            return self.empty(shape, dtype)
+        return np.empty(shape, dtype=dtype)
+
+    def copy(self, array):
+        """ Writable copy of array, in a scratch file if it would take the editor past the threshold """
+        copy = self.allocate(array.shape, array.dtype)
+        copy[...] = array
+        return copy
+
+    def spill(self, array):
+        """ Returns array, or a copy of it in a scratch file while the editor is spilling.
+        Only saves memory for arrays the caller owns and drops once it has the copy, never
+        for views of pixmaps or other buffers that stay alive. """
+        if not self.isSpilling() or array.nbytes == 0:
+            return array
+        copy = self.empty(array.shape, array.dtype)
+        copy[...] = array
+        copy.flags.writeable = array.flags.writeable
+        return copy
+
+    def store(self, data):
+        """ Returns bytes-like data, or a read-only memoryview of a copy in a scratch file while
+        the editor is spilling. Small blocks share files. """
+        if not self.isSpilling():
+            return data
+        size = len(data)
+        with self._lock:
+            if size > ARENA_SIZE:
+                arena = Arena(self.directory, size)
+            else:
+                if self._arena is None or self._arena.offset + size > self._arena.size:
+                    self._arena = Arena(self.directory, ARENA_SIZE)
+                arena = self._arena
+            offset = arena.offset
+            arena.offset += size
+        arena.map[offset:offset + size] = data
+        return memoryview(arena.map)[offset:offset + size].toreadonly()
+
+
+# Shared by the history, the render caches and the tools
+defaultScratchDisk = ScratchDisk()
@@ -0,0 +1,96 @@
+""" SelectionMask.py: A selection rasterized once into an alpha mask over its bounding box.
+
+Adjustments with an active selection only process the bounding box crop of the image
+and blend the result back through the mask, so their cost follows the size of the
+selection rather than the size of the image. Rectangles need no mask at all.
+"""
+
+import numpy as np
+from PyQt6 import QtCore, QtGui
+
+from QImageBridge import QImageToAlpha
+from ScratchDisk import defaultScratchDisk
+
+
+class SelectionMask:
+
+    def __init__(self, key, top, left, bottom, right, alpha=None):
+        # Identifies the selection geometry and the image size it was rasterized for
+        self.key = key
+
+        # Bounding box in image pixels, bottom and right exclusive
+        self.top = top
+        self.left = left
+        self.bottom = bottom
+        self.right = right
+
+        # Coverage of every pixel in the box, 0 to 255, or None if all of it is selected
+        self.alpha = alpha
+
+    @staticmethod
+    def rectKey(rect, width, height):
+        """ Key of the selection of a QRect clipped to a width x height image, the one
+        fromRect() gives it, or None if the clipped rect is empty """
+        rect = rect.intersected(QtCore.QRect(0, 0, width, height))
+        if rect.isEmpty():
+            return None
+        return ("rect", rect.x(), rect.y(), rect.width(), rect.height(), width, height)
+
+    @staticmethod
+    def polygonKey(points, width, height):
+        """ Key of the selection of a polygon, the one fromPolygon() gives it """
+        return ("polygon", tuple((point.x(), point.y()) for point in points), width, height)
+
+    @classmethod
+    def fromRect(cls, rect, width, height):
+        """ Selection of a QRect, clipped to a width x height image. Returns None if empty. """
+        key = cls.rectKey(rect, width, height)
+        if key is None:
+            return None
+        _, left, top, rectWidth, rectHeight, _, _ = key
+        return cls(key, top, left, top + rectHeight, left + rectWidth)
+
+    @classmethod
+    def fromPolygon(cls, points, width, height):
+        """ Antialiased selection of the polygon through points, a list of QPointF in image
+        coordinates, clipped to a width x height image. Returns None if empty. """
+        polygon = QtGui.QPolygonF(points)
+        box = polygon.boundingRect().toAlignedRect().intersected(QtCore.QRect(0, 0, width, height))
+        if box.isEmpty():
+            return None
+
+        mask = QtGui.QImage(box.width(), box.height(), QtGui.QImage.Format.Format_Alpha8)
+        mask.fill(0)
+        painter = QtGui.QPainter(mask)
+        painter.setRenderHint(QtGui.QPainter.RenderHint.Antialiasing)
+        painter.translate(-box.left(), -box.top())
+        path = QtGui.QPainterPath()
+        path.addPolygon(polygon)
+        path.closeSubpath()
+        painter.fillPath(path, QtGui.QColor(0, 0, 0, 255))
+        painter.end()
+
+        return cls(cls.polygonKey(points, width, height), box.top(), box.left(), box.bottom() + 1, box.right() + 1, QImageToAlpha(mask))
+
+    def crop(self, buffer):
+        """ View of the bounding box of buffer """
+        return buffer[self.top:self.bottom, self.left:self.right]
+
+    def composite(self, source, processed, out=None):
+        """ Returns source with processed, the processed crop, blended in through the mask.
+        Without out a copy of source is returned; out may be source itself. """
+        if out is None:
+            out = defaultScratchDisk.copy(source)
+        target = self.crop(out)
+        if self.alpha is None:
+            target[...] = processed
+            return out
+
+        # Integer blend, rounded: (processed * alpha + original * (255 - alpha)) / 255
+        alpha = self.alpha[..., np.newaxis].astype(np.uint16)
+        blended = processed.astype(np.uint16) * alpha
+        blended += self.crop(source).astype(np.uint16) * (255 - alpha)
+        blended += 127
+        blended //= 255
+        target[...] = blended
+        return out
@@ -0,0 +1,58 @@
+""" StageCache.py: Memory bounded LRU cache of intermediate render buffers.
+
+The adjustment chain stores the output of every pass under the identity of its source
+and the parameters of all passes up to it. Moving a late slider then restarts from the
+cached output of the passes before it. Least recently used buffers are dropped once
+their total size exceeds the budget.
+
+Cached buffers are shared by every render that hits them, so they are made read-only.
+While the editor is short of RAM they are kept on the scratch disk.
+"""
+
+import collections
+import threading
+
+from ScratchDisk import defaultScratchDisk
+
+
+class StageCache:
+
+    def __init__(self, budget=512 * 1024 * 1024):
+        # Bytes of buffers kept at most
+        self.budget = budget
+        self.size = 0
+        self._buffers = collections.OrderedDict()
+
+        # Renders run on worker threads
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the buffer stored under key, or None """
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is not None:
+                self._buffers.move_to_end(key)
+            return buffer
+
+    def put(self, key, buffer):
+        """ Stores buffer under key and makes it read-only. Returns the stored buffer, which
+        the caller uses from then on: it is a scratch disk copy while the editor is spilling. """
+        buffer.flags.writeable = False
+        if buffer.nbytes > self.budget:
+            return buffer
+        buffer = defaultScratchDisk.spill(buffer)
+        with self._lock:
+            previous = self._buffers.pop(key, None)
+            if previous is not None:
+                self.size -= previous.nbytes
+            self._buffers[key] = buffer
+            self.size += buffer.nbytes
+            while self.size > self.budget:
+                _, evicted = self._buffers.popitem(last=False)
+                self.size -= evicted.nbytes
+        return buffer
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+            self.size = 0
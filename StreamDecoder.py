@@ -0,0 +1,165 @@
+""" StreamDecoder.py: Decodes images beyond the Qt allocation limit band by band.
+
+QImageReader allocates the whole decoded image at once and refuses images larger than
+its allocation limit (QT_IMAGEIO_MAXALLOC, in MB). For such images decode() allocates
+the BGRA buffer of the editor up front, on the scratch disk if it would not fit in RAM
+(see ScratchDisk), and fills it piece by piece:
+
+    - Binary PPM and PGM (P6, P5): the pixel data is memory mapped and converted in
+      bands of BAND_ROWS rows.
+    - Uncompressed TIFF, striped or tiled: every strip or tile of the file is memory
+      mapped and converted on its own.
+    - PNG and compressed TIFF are single zlib or libtiff streams that cannot be decoded
+      in independent pieces. They are decoded by PIL, which the Qt limit does not bind,
+      and converted in bands, so peak memory is the PIL image plus the buffer.
+
+Bands and tiles are converted in parallel on the TileScheduler pool. The buffer wraps
+into a QImage and a QPixmap without a copy (see QImageBridge), so the viewer, the history
+and the tools all share it.
+"""
+
+import re
+import threading
+import warnings
+
+import numpy as np
+from PIL import Image
+from PyQt6 import QtGui
+
+from PointOpCompiler import ALPHA, BLUE, GREEN, RED
+from ScratchDisk import defaultScratchDisk
+from TileScheduler import defaultScheduler
+
+# Rows converted at once
+BAND_ROWS = 256
+
+# Channels of the uncompressed TIFF sample layouts read directly, as PIL names them
+TIFF_CHANNELS = {"L": 1, "RGB": 3, "RGBX": 4, "RGBA": 4}
+
+# PNM header: magic, width, height and maximum sample value, with comments in between
+PNM_HEADER = re.compile(rb"(P[56])(?:\s+(?:#[^\n]*\n)?)+?(\d+)(?:\s+(?:#[^\n]*\n)?)+?(\d+)(?:\s+(?:#[^\n]*\n)?)+?(\d+)\s")
+
+# PIL refuses very large images by default, the limit is lifted while the editor opens one
+pilLock = threading.Lock()
+
+
+def isBeyondAllocationLimit(width, height):
+    """ True if QImageReader refuses to decode an image of this size """
+    limit = QtGui.QImageReader.allocationLimit()
+    return limit > 0 and width * height * 4 > limit * 1024 * 1024
+
+
+def convertPixels(pixels, out):
+    """ Writes (height, width, channels) samples in R, G, B(, A) or grey order into a BGRA
+    block of the same height and width """
+    if pixels.shape[2] < 3:
+        out[..., :3] = pixels[..., :1]
+    else:
+        out[..., RED] = pixels[..., 0]
+        out[..., GREEN] = pixels[..., 1]
+        out[..., BLUE] = pixels[..., 2]
+    out[..., ALPHA] = pixels[..., 3] if pixels.shape[2] == 4 else 255
+
+
+def bands(height):
+    return [slice(top, min(top + BAND_ROWS, height)) for top in range(0, height, BAND_ROWS)]
+
+
+def decodePnm(filepath):
+    """ Binary PPM or PGM, or None if the file is not one """
+    with open(filepath, "rb") as file:
+        match = PNM_HEADER.match(file.read(1024))
+    if match is None:
+        return None
+    magic, width, height, maximum = match.group(1), int(match.group(2)), int(match.group(3)), int(match.group(4))
+    channels = 3 if magic == b"P6" else 1
+    dtype = np.dtype(np.uint8) if maximum < 256 else np.dtype(">u2")
+    samples = np.memmap(filepath, dtype=dtype, mode="r", offset=match.end(), shape=(height, width, channels))
+
+    out = defaultScratchDisk.allocate((height, width, 4))
+
+    def convertBand(rows):
+        pixels = samples[rows]
+        if maximum != 255:
+            pixels = (pixels.astype(np.uint32) * 255 + maximum // 2) // maximum
+        convertPixels(pixels, out[rows])
+
+    defaultScheduler.starmap(convertBand, [(rows,) for rows in bands(height)])
+    return out, False
+
+
+def decodeTiff(image, filepath):
+    """ Uncompressed TIFF read strip by strip, or None if image has other strips """
+    if image.mode not in TIFF_CHANNELS or not image.tile:
+        return None
+    for tile in image.tile:
+        if tile[0] != "raw" or tile[3][0] != image.mode:
+            return None
+
+    width, height = image.size
+    channels = TIFF_CHANNELS[image.mode]
+    data = np.memmap(filepath, dtype=np.uint8, mode="r")
+    out = defaultScratchDisk.allocate((height, width, 4))
+
+    def convertTile(extents, offset, stride, orientation):
+        left, top, right, bottom = extents
+        stride = stride or (right - left) * channels
+        rows = data[offset:offset + (bottom - top) * stride].reshape(bottom - top, stride)
+        pixels = rows[:, :(right - left) * channels].reshape(bottom - top, right - left, channels)
+        if orientation < 0:
+            pixels = pixels[::-1]
+        convertPixels(pixels[..., :3] if image.mode == "RGBX" else pixels, out[top:bottom, left:right])
+
+    defaultScheduler.starmap(convertTile, [(tile[1], tile[2], tile[3][1], tile[3][2]) for tile in image.tile])
+    return out, image.mode == "RGBA"
+
+
+def decodeWithPil(image):
+    """ Any image PIL can read, decoded whole and converted in bands """
+    image.load()
+    width, height = image.size
+    hasAlpha = "A" in image.getbands() or "transparency" in image.info
+    out = defaultScratchDisk.allocate((height, width, 4))
+
+    def convertBand(rows):
+        band = image.crop((0, rows.start, width, rows.stop)).convert("RGBA")
+        convertPixels(np.asarray(band), out[rows])
+
+    # PIL images are not safe to crop from several threads
+    for rows in bands(height):
+        convertBand(rows)
+    return out, hasAlpha
+
+
+def decode(filepath):
+    """ Returns (BGRA buffer, whether it has an alpha channel) of filepath, or None if
+    neither this module nor PIL can read it, or it is truncated """
+    try:
+        return decodeFile(filepath)
+    except (OSError, ValueError):
+        return None
+
+
+def decodeFile(filepath):
+    decoded = decodePnm(filepath)
+    if decoded is not None:
+        return decoded
+
+    with pilLock:
+        limit = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+                image = Image.open(filepath)
+        except OSError:
+            return None
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+
+    with image:
+        if image.format == "TIFF":
+            decoded = decodeTiff(image, filepath)
+            if decoded is not None:
+                return decoded
+        return decodeWithPil(image)
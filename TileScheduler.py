@@ -0,0 +1,105 @@
+""" TileScheduler.py: Runs pixel operations tile by tile on a pool of threads.
+
+A buffer is cut into tiles small enough to stay in the CPU caches. Neighbourhood
+operations (blur, sharpen) read their tile with a halo of extra pixels on each side and
+only the tile itself is written back, so the result matches a whole-frame run. NumPy and
+OpenCV release the GIL inside their kernels, which lets the tiles run in parallel.
+
+Results are written straight into the output buffer; point operations can use the source
+buffer as output and run fully in place.
+"""
+
+import concurrent.futures
+import os
+
+import numpy as np
+
+from ScratchDisk import defaultScratchDisk
+
+
+class TileScheduler:
+
+    def __init__(self, threads=None, tileSize=256, minimumPixels=512 * 512):
+        # Tiles are tileSize rows high and 4 * tileSize columns wide
+        self.tileSize = tileSize
+
+        # Buffers smaller than this run on the calling thread in one piece
+        self.minimumPixels = minimumPixels
+
+        self._executor = None
+        self.setThreadCount(threads or os.cpu_count() or 1)
+
+    def setThreadCount(self, threads):
+        """ Resizes the pool, running tiles finish on the old one """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self.threads = max(1, int(threads))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="tile")
+
+    def tiles(self, height, width, halo=0):
+        """ Yields (inner, outer, local) slice pairs for every tile.
+        inner is the tile in buffer coordinates, outer the tile grown by halo and clipped to the
+        buffer, and local the position of inner within outer. """
+        tileHeight = self.tileSize
+        tileWidth = self.tileSize * 4
+        for top in range(0, height, tileHeight):
+            bottom = min(top + tileHeight, height)
+            outerTop = max(0, top - halo)
+            outerBottom = min(height, bottom + halo)
+            for left in range(0, width, tileWidth):
+                right = min(left + tileWidth, width)
+                outerLeft = max(0, left - halo)
+                outerRight = min(width, right + halo)
+                yield ((slice(top, bottom), slice(left, right)),
+                       (slice(outerTop, outerBottom), slice(outerLeft, outerRight)),
+                       (slice(top - outerTop, bottom - outerTop), slice(left - outerLeft, right - outerLeft)))
+
+    def isSmall(self, source):
+        return self.threads == 1 or source.shape[0] * source.shape[1] < self.minimumPixels
+
+    def map(self, function, source, out=None, halo=0):
+        """ Writes function(tile) into out for every tile of source and returns out.
+        function receives the tile grown by halo and returns a result of the same shape; it
+        must not write to its input when halo > 0, since neighbouring tiles overlap.
+        Without out a new buffer is allocated, on the scratch disk once RAM runs short. out
+        may be source itself when halo is 0. """
+        if out is None:
+            out = defaultScratchDisk.allocate(source.shape, source.dtype)
+
+        if self.isSmall(source):
+            result = function(source)
+            if result is not out:
+                out[...] = result
+            return out
+
+        def runTile(inner, outer, local):
+            result = function(source[outer])
+            target = out[inner]
+            # Nothing to copy if function worked in place on out
+            if not np.may_share_memory(result, target):
+                target[...] = result[local]
+
+        futures = [self._executor.submit(runTile, *tile) for tile in self.tiles(source.shape[0], source.shape[1], halo)]
+        for future in futures:
+            # Re-raises the exception of a failed tile
+            future.result()
+        return out
+
+    def reduce(self, function, source, *sources):
+        """ Returns the list of function(tile) over all tiles of source, in tile order.
+        Further sources of the same height and width are tiled alongside, function then
+        receives their tiles at the same place as extra arguments. """
+        if self.isSmall(source):
+            return [function(source, *sources)]
+        futures = [self._executor.submit(function, source[inner], *(other[inner] for other in sources))
+                   for inner, _, _ in self.tiles(source.shape[0], source.shape[1])]
+        return [future.result() for future in futures]
+
+    def starmap(self, function, arguments):
+        """ Returns [function(*item) for item in arguments], computed on the pool """
+        futures = [self._executor.submit(function, *item) for item in arguments]
+        return [future.result() for future in futures]
+
+
+# Shared by every pixel operation in the editor
+defaultScheduler = TileScheduler()
@@ -20,6 +20,9 @@ import numpy as np
 import numpy.matlib
 import cv2
 
+from ScratchDisk import defaultScratchDisk
+from TileScheduler import defaultScheduler
+
 
 class WBsRGB:
   def __init__(self, gamut_mapping=2):
@@ -104,23 +107,28 @@ class WBsRGB:
     return I_corr
 
   def colorCorrection(self, input, m):
-    """ Applies a mapping function m to a given input image. """
-    sz = np.shape(input)  # get size of input image
-    I_reshaped = np.reshape(input, (int(input.size / 3), 3), order="F")
-    kernel_out = kernelP(I_reshaped)
-    out = np.dot(kernel_out, m)
-    if self.gamut_mapping == 1:
-      # scaling based on input image energy
-      out = normScaling(I_reshaped, out)
-    elif self.gamut_mapping == 2:
-      # clip out-of-gamut pixels
-      out = outOfGamutClipping(out)
-    else:
+    """ Applies a mapping function m to a given input image.
+    The mapping is per pixel, so the image is corrected tile by tile in parallel. """
+    if self.gamut_mapping not in (1, 2):
       raise Exception('Wrong gamut_mapping value')
-    # reshape output image back to the original image shape
-    out = out.reshape(sz[0], sz[1], sz[2], order="F")
-    out = out.astype('float32')[..., ::-1]  # convert from BGR to RGB
-    return out
+
+    def correctTile(tile):
+      sz = np.shape(tile)  # get size of input tile
+      I_reshaped = np.reshape(tile, (int(tile.size / 3), 3))
+      kernel_out = kernelP(I_reshaped)
+      out = np.dot(kernel_out, m)
+      if self.gamut_mapping == 1:
+        # scaling based on input image energy
+        out = normScaling(I_reshaped, out)
+      else:
+        # clip out-of-gamut pixels
+        out = outOfGamutClipping(out)
+      # reshape output tile back to the original tile shape
+      out = out.reshape(sz[0], sz[1], sz[2])
+      return out.astype('float32')[..., ::-1]  # convert from BGR to RGB
+
+    out = defaultScratchDisk.allocate(np.shape(input), dtype='float32')
+    return defaultScheduler.map(correctTile, input, out=out)
 
 
 def normScaling(I, I_corr):
@@ -10,14 +10,24 @@ from PyQt6.QtWidgets import (
 )
 from PyQt6.QtGui import QPixmap
 import sys
+import collections
+import functools
 
 from QImageViewer import QtImageViewer
 from PyQt6.QtGui import QKeySequence
 import pyqtgraph as pg
 import os
 from QFlowLayout import QFlowLayout
-from PIL import Image, ImageEnhance, ImageFilter
+import numpy as np
 import QCurveWidget
+from AdjustmentEngine import AdjustmentEngine
+from ProxyPreview import ProxyPreview
+from QRenderWorker import QRenderQueue
+from QRenderScheduler import QRenderScheduler
+from QImageBridge import ArrayToImage, ArrayToQPixmap, QPixmapToArray
+from HistogramEngine import BLUE_HISTOGRAM, GREEN_HISTOGRAM, LUMA_HISTOGRAM, RED_HISTOGRAM, HistogramEngine
+from ScratchDisk import defaultScratchDisk
+from RawDecoder import isRaw
 
 class Gui(QtWidgets.QMainWindow):
 
@@ -31,6 +41,10 @@ class Gui(QtWidgets.QMainWindow):
         self.statusBar = QStatusBar()
         self.setStatusBar(self.statusBar)
 
+        # Memory held by the undo history, see UpdateHistoryMemory()
+        self.historyMemoryLabel = QLabel()
+        self.statusBar.addPermanentWidget(self.historyMemoryLabel)
+
         ##############################################################################################
         ##############################################################################################
         # Create Histogram
@@ -78,7 +92,28 @@ class Gui(QtWidgets.QMainWindow):
         # State of filter sliders
         self.GaussianBlurRadius = 0
 
-        self.timer_id = -1
+        self.adjustmentEngine = AdjustmentEngine()
+
+        # Proxy rendering while a slider is being dragged
+        self.proxyPreview = ProxyPreview()
+
+        # Histograms of the image shown, see UpdateHistogramPlot()
+        self.histogramEngine = HistogramEngine()
+        self.histogramStale = True
+        # (source HistoryImage, table) if the next image change is a point operation on the source
+        self.nextHistogramDerivation = None
+        self.histogramDerivation = None
+        # RemapSources of recent point operation sources, keyed by pixmap
+        self.histogramSources = collections.OrderedDict()
+        self.isDraggingSlider = False
+        self.sliderSourceKey = None
+        self.sliderSource = None
+        self.sliderPreviewRendered = False
+        self.sliderRenderContext = None
+        # (source HistoryImage, replay function, pixmap, slider state) of the last full resolution render
+        self.sliderReplay = None
+        # Renders only run and reach the view while the Adjust window is open
+        self.slidersOpen = False
         self.sliderExplanationOfChange = None
         self.sliderTypeOfChange = None
         self.sliderValueOfChange = None
@@ -284,6 +319,19 @@ class Gui(QtWidgets.QMainWindow):
         self.sliderChangeSignal.connect(self.onUpdateImageCompleted)
         self.sliderWorkers = []
 
+        # Slider renders run on the thread pool, only the latest result is shown
+        self.renderQueue = QRenderQueue(self.threadpool, self.sliderWorkers)
+        self.renderQueue.completedSignal.connect(self.onSliderRenderCompleted)
+        self.renderQueue.failedSignal.connect(self.onSliderRenderFailed)
+        self.renderScheduler = QRenderScheduler(self.renderQueue, self.submitSliderRender)
+        self.renderScheduler.latencySignal.connect(self.onSliderLatency)
+
+        # Histogram refreshes are coalesced to one per display frame
+        self.histogramTimer = QtCore.QTimer(self)
+        self.histogramTimer.setSingleShot(True)
+        self.histogramTimer.setInterval(int(1000 / max(self.screen().refreshRate(), 1)))
+        self.histogramTimer.timeout.connect(self.RefreshHistogramPlot)
+
         self.resizeDockWidgets()
 
     def setIconPixmapWithColor(self, button, filename, findColor='black', newColor='white'):
@@ -314,6 +362,9 @@ class Gui(QtWidgets.QMainWindow):
 
     def initImageViewer(self):
         self.image_viewer = QtImageViewer(self)
+        self.image_viewer.imageOpening.connect(self.OnImageOpening)
+        self.image_viewer.imageOpened.connect(self.OnImageOpened)
+        self.image_viewer.imageOpenFailed.connect(self.OnImageOpenFailed)
         self.CurvesDock = None
 
         # Set viewer's aspect ratio mode.
@@ -374,53 +425,36 @@ class Gui(QtWidgets.QMainWindow):
     def getCurrentLayerLatestPixmap(self):
         return self.image_viewer.getCurrentLayerLatestPixmap()
 
+    def getSliderState(self):
+        return {
+            "RedFactor": self.RedFactor,
+            "GreenFactor": self.GreenFactor,
+            "BlueFactor": self.BlueFactor,
+            "Color": self.Color,
+            "Brightness": self.Brightness,
+            "Contrast": self.Contrast,
+            "Sharpness": self.Sharpness,
+            "GaussianBlurRadius": self.GaussianBlurRadius,
+        }
+
     def processSliderChange(self, explanationOfChange, typeOfChange, valueOfChange, objectOfChange):
         self.sliderExplanationOfChange = explanationOfChange
         self.sliderTypeOfChange = typeOfChange
         self.sliderValueOfChange = valueOfChange
         self.sliderObjectOfChange = objectOfChange
 
-        if self.timer_id != -1:
-            self.killTimer(self.timer_id)
-
-        self.timer_id = self.startTimer(500)
-
-    def QPixmapToImage(self, pixmap):
-        width = pixmap.width()
-        height = pixmap.height()
-        image = pixmap.toImage()
-
-        byteCount = image.bytesPerLine() * height
-        data = image.constBits().asstring(byteCount)
-        return Image.frombuffer('RGBA', (width, height), data, 'raw', 'BGRA', 0, 1)
+        # Renders right away when idle, otherwise once the running render finishes
+        self.renderScheduler.request()
 
-    def ImageToQPixmap(self, image):
-        from PIL.ImageQt import ImageQt
-        return QPixmap.fromImage(ImageQt(image))
+    def OnSliderPressed(self):
+        self.isDraggingSlider = True
 
-    def EnhanceImage(self, Pixmap, Property, value):
-        CurrentImage = self.QPixmapToImage(Pixmap)
-        AdjustedImage = Property(CurrentImage).enhance(float(value) / 100)
-        return self.ImageToQPixmap(AdjustedImage)
-
-    def ApplyGaussianBlur(self, Pixmap, value):
-        CurrentImage = self.QPixmapToImage(Pixmap)
-        AdjustedImage = CurrentImage.filter(ImageFilter.GaussianBlur(radius=value))
-        return self.ImageToQPixmap(AdjustedImage)
-
-    def UpdateReds(self, Pixmap, value):
-        CurrentImage = self.QPixmapToImage(Pixmap)
-
-        # Split into channels
-        r, g, b, a = CurrentImage.split()
-
-        # Increase Reds
-        r = r.point(lambda i: i * value)
-
-        # Recombine back to RGB image
-        AdjustedImage = Image.merge('RGBA', (r, g, b, a))
-
-        return self.ImageToQPixmap(AdjustedImage)
+    def OnSliderReleased(self):
+        self.isDraggingSlider = False
+        if self.sliderPreviewRendered:
+            # Replace the proxy with a full resolution render, a running proxy render is stale
+            self.sliderPreviewRendered = False
+            self.renderScheduler.request(urgent=True)
 
     def AddRedColorSlider(self, layout):
         self.RedColorSlider = QSlider(QtCore.Qt.Orientation.Horizontal)
@@ -436,20 +470,6 @@ class Gui(QtWidgets.QMainWindow):
         self.RedFactor = value
         self.processSliderChange("Red", "Slider", value, "RedColorSlider")
 
-    def UpdateGreens(self, Pixmap, value):
-        CurrentImage = self.QPixmapToImage(Pixmap)
-
-        # Split into channels
-        r, g, b, a = CurrentImage.split()
-
-        # Increase Greens
-        g = g.point(lambda i: i * value)
-
-        # Recombine back to RGB image
-        AdjustedImage = Image.merge('RGBA', (r, g, b, a))
-
-        return self.ImageToQPixmap(AdjustedImage)
-
     def AddGreenColorSlider(self, layout):
         self.GreenColorSlider = QSlider(QtCore.Qt.Orientation.Horizontal)
         self.GreenColorSlider.setRange(0, 200) # 1 is original image, 0 is black image
@@ -464,20 +484,6 @@ class Gui(QtWidgets.QMainWindow):
         self.GreenFactor = value
         self.processSliderChange("Green", "Slider", value, "GreenColorSlider")
 
-    def UpdateBlues(self, Pixmap, value):
-        CurrentImage = self.QPixmapToImage(Pixmap)
-
-        # Split into channels
-        r, g, b, a = CurrentImage.split()
-
-        # Increase Blues
-        b = b.point(lambda i: i * value)
-
-        # Recombine back to RGB image
-        AdjustedImage = Image.merge('RGBA', (r, g, b, a))
-
-        return self.ImageToQPixmap(AdjustedImage)
-
     def AddBlueColorSlider(self, layout):
         self.BlueColorSlider = QSlider(QtCore.Qt.Orientation.Horizontal)
         self.BlueColorSlider.setRange(0, 200) # 1 is original image, 0 is black image
@@ -558,84 +564,207 @@ class Gui(QtWidgets.QMainWindow):
         self.GaussianBlurRadius = value
         self.processSliderChange("Gaussian Blur", "Slider", value, "GaussianBlurSlider")
 
-    def UpdateHistogramPlot(self):
-        # Compute image histogram
-        img = self.QPixmapToImage(self.image_viewer.pixmap())
-        r, g, b, a = img.split()
-        r_histogram = r.histogram()
-        g_histogram = g.histogram()
-        b_histogram = b.histogram()
+    def UpdateHistoryMemory(self):
+        # Called by the viewer whenever the history changes
+        used, uncompressed, scratch = self.image_viewer.historyStore.memoryBytes()
+        text = "History " + str(used // 2**20) + " MB (" + str(uncompressed // 2**20) + " MB uncompressed)"
+        if scratch:
+            text += ", " + str(scratch // 2**20) + " MB on scratch disk"
+        self.historyMemoryLabel.setText(text)
 
-        # ITU-R 601-2 luma transform:
-        luma_histogram = [sum(x) for x in zip([item * float(299/1000) for item in r_histogram],
-                                              [item * float(587/1000) for item in g_histogram],
-                                              [item * float(114/1000) for item in b_histogram])]
+    def UpdateHistogramPlot(self):
+        # Called by the viewer on every image change, the histogram is only marked stale here
+        # A derivation only applies to the image change right after it was set
+        self.histogramDerivation = self.nextHistogramDerivation
+        self.nextHistogramDerivation = None
+        self.histogramStale = True
+        if self.ImageHistogramPlot.isVisible() and not self.histogramTimer.isActive():
+            self.histogramTimer.start()
+
+    def DeriveNextHistogram(self, source, table):
+        # The next image change maps the HistoryImage source through the (4, 256) table, its
+        # histogram is then remapped from the histograms source keeps in its ImageStats
+        self.nextHistogramDerivation = (source, table)
+
+    def RefreshHistogramPlot(self, exact=False):
+        # Recompute a stale histogram, exact counts every pixel instead of a sample
+        if not (self.histogramStale or exact) or not self.image_viewer.hasImage():
+            return
+        mask = self.image_viewer.selectionMask()
+
+        stats = self.image_viewer.imageStats()
+        if self.histogramDerivation is not None and mask is None and not exact:
+            # The stats of the source hold the whole image, a selection is counted instead
+            source, table = self.histogramDerivation
+            histograms = self.getHistogramSource(source).remap(table)
+        elif mask is None and stats is not None and (exact or stats.isComputed()):
+            # Counted once per history entry, undo shows an entry counted before
+            histograms = stats.histograms()
+        else:
+            # Compute image histogram, of the selection if there is one
+            buffer = QPixmapToArray(self.image_viewer.pixmap(), writable=False)
+            histograms = self.histogramEngine.selectionHistograms(buffer, mask, exact)
+        self.histogramStale = False
 
         # Update histogram plot
-        self.ImageHistogramGraphRed.setData(y=r_histogram)
-        self.ImageHistogramGraphGreen.setData(y=g_histogram)
-        self.ImageHistogramGraphBlue.setData(y=b_histogram)
-        self.ImageHistogramGraphLuma.setData(y=luma_histogram)
+        self.ImageHistogramGraphRed.setData(y=histograms[RED_HISTOGRAM])
+        self.ImageHistogramGraphGreen.setData(y=histograms[GREEN_HISTOGRAM])
+        self.ImageHistogramGraphBlue.setData(y=histograms[BLUE_HISTOGRAM])
+        self.ImageHistogramGraphLuma.setData(y=histograms[LUMA_HISTOGRAM])
+
+    def getHistogramSource(self, source):
+        # RemapSource of a point operation source, built once per source from its exact
+        # histograms, counted at most once per history entry
+        pixmap = source.pixmap()
+        key = pixmap.cacheKey()
+        if key not in self.histogramSources:
+            buffer = QPixmapToArray(pixmap, writable=False)
+            self.histogramSources[key] = self.histogramEngine.remapSource(buffer, source.stats.histograms(buffer))
+            if len(self.histogramSources) > 16:
+                self.histogramSources.popitem(last=False)
+        self.histogramSources.move_to_end(key)
+        return self.histogramSources[key]
 
     @QtCore.pyqtSlot()
     def onUpdateImageCompleted(self):
         if self.sliderChangedPixmap:
             self.image_viewer.setImage(self.sliderChangedPixmap, False, self.sliderExplanationOfChange, 
                                        self.sliderTypeOfChange, self.sliderValueOfChange, self.sliderObjectOfChange)
-            self.UpdateHistogramPlot()
-
-    def timerEvent(self, event):
-        self.killTimer(self.timer_id)
-        self.timer_id = -1
 
+    def submitSliderRender(self):
+        # Called by the render scheduler, returns the generation of the submitted render
         Pixmap = self.image_viewer.getCurrentLayerLatestPixmap()
-        OriginalPixmap = Pixmap.copy()
-
-        # TODO: If a selection is active
-        # Only apply changes to the selected region
-        if self.image_viewer._isSelectingRect:
-            print(self.image_viewer._selectRect)
-            Pixmap = Pixmap.copy(self.image_viewer._selectRect.toRect())
-        elif self.image_viewer._isSelectingPath:
-            Pixmap = self.image_viewer.getSelectedRegionAsPixmap()
-
-        if Pixmap:
-            if self.RedFactor != 100:
-                Pixmap = self.UpdateReds(Pixmap, float(self.RedFactor / 100))
-            if self.GreenFactor != 100:
-                Pixmap = self.UpdateGreens(Pixmap, float(self.GreenFactor / 100))
-            if self.BlueFactor != 100:
-                Pixmap = self.UpdateBlues(Pixmap, float(self.BlueFactor / 100))
-            if self.Color != 100:
-                Pixmap = self.EnhanceImage(Pixmap, ImageEnhance.Color, self.Color)
-            if self.Brightness != 100:
-                Pixmap = self.EnhanceImage(Pixmap, ImageEnhance.Brightness, self.Brightness)
-            if self.Contrast != 100:
-                Pixmap = self.EnhanceImage(Pixmap, ImageEnhance.Contrast, self.Contrast)
-            if self.Sharpness != 100:
-                Pixmap = self.EnhanceImage(Pixmap, ImageEnhance.Sharpness, self.Sharpness)
-            if self.GaussianBlurRadius > 0:
-                Pixmap = self.ApplyGaussianBlur(Pixmap, float(self.GaussianBlurRadius / 100))
-
-            if self.image_viewer._isSelectingRect:
-                painter = QtGui.QPainter(OriginalPixmap)
-                selectRect = self.image_viewer._selectRect
-                point = QtCore.QPoint(int(selectRect.x()), int(selectRect.y()))
-                painter.drawPixmap(point, Pixmap)
-                painter.end()
-                Pixmap = OriginalPixmap
-            elif self.image_viewer._isSelectingPath:
-                painter = QtGui.QPainter(OriginalPixmap)
-                painter.drawPixmap(QtCore.QPoint(), Pixmap)
-                painter.end()
-                Pixmap = OriginalPixmap
-
-            self.sliderChangedPixmap = Pixmap
-            self.sliderExplanationOfChange = self.sliderExplanationOfChange
-            self.sliderTypeOfChange = self.sliderTypeOfChange
-            self.sliderValueOfChange = self.sliderValueOfChange
-            self.sliderObjectOfChange = self.sliderObjectOfChange
-            self.sliderChangeSignal.emit()
+        if not Pixmap or not self.slidersOpen:
+            return None
+
+        # Pixel work runs on the thread pool, the GUI thread only slices the cached source
+        key = Pixmap.cacheKey()
+        source = self.getSliderSource(Pixmap)
+        state = self.getSliderState()
+        engine = self.adjustmentEngine
+
+        # Contrast reads the mean grey level of the source from its history entry
+        stats = self.image_viewer.getCurrentLayerLatestStats()
+        sourceMean = functools.partial(stats.meanLuma, source)
+
+        # With a selection only its bounding box is rendered, then blended back through its mask
+        mask = self.image_viewer.selectionMask()
+
+        if self.isDraggingSlider and mask is None and not engine.isIdentity(state):
+            # Full resolution is rendered once the slider is released, the identity needs no proxy
+            displayRect = self.image_viewer.mapFromScene(self.image_viewer.sceneRect()).boundingRect()
+            ratio = self.image_viewer.devicePixelRatioF()
+            displayWidth = displayRect.width() * ratio
+            displayHeight = displayRect.height() * ratio
+            proxyPreview = self.proxyPreview
+
+            def render(isCancelled):
+                buffer = proxyPreview.proxy(key, source, displayWidth, displayHeight)
+                return engine.render(buffer, state, isCancelled, scale=buffer.shape[1] / source.shape[1], key=("proxy", key, buffer.shape), sourceMean=sourceMean)
+
+            self.sliderRenderContext = {"preview": True}
+            self.sliderPreviewRendered = True
+            return self.renderQueue.submit(render)
+
+        # Renders of the cached source resume from the stage cache
+        region = source
+        regionKey = (key,)
+        if mask is not None:
+            region = mask.crop(source)
+            regionKey = (key, mask.key)
+            sourceMean = None
+
+        def render(isCancelled):
+            buffer = engine.render(region, state, isCancelled, key=regionKey, sourceMean=sourceMean)
+            if buffer is None or mask is None:
+                return buffer
+            return mask.composite(source, buffer)
+
+        # Point operation chains let the histogram be remapped instead of counted, contrast
+        # only once the mean is known without a pass on this thread
+        tableMean = sourceMean if stats.isComputed() else None
+        self.sliderRenderContext = {"preview": False, "table": engine.pointTable(state, tableMean),
+                                    "base": self.image_viewer.getCurrentLayerLatestImage(), "state": state, "mask": mask}
+        return self.renderQueue.submit(render)
+
+    def getSliderSource(self, Pixmap):
+        # Read-only BGRA view of the slider source, shared with its pixmap
+        key = Pixmap.cacheKey()
+        if self.sliderSourceKey != key:
+            self.sliderSourceKey = key
+            self.sliderSource = QPixmapToArray(Pixmap, writable=False)
+        return self.sliderSource
+
+    @QtCore.pyqtSlot(int, object, float)
+    def onSliderRenderCompleted(self, generation, buffer, seconds):
+        # Only the latest render reaches this point, stale ones are dropped by the queue
+        if not self.slidersOpen:
+            return
+        context = self.sliderRenderContext
+        Pixmap = ArrayToQPixmap(buffer)
+
+        if context["preview"]:
+            self.sliderReplay = None
+            self.image_viewer.setPreviewImage(Pixmap)
+            self.proxyPreview.recordRenderTime(seconds, buffer.shape[0] * buffer.shape[1])
+            self.renderScheduler.presented(generation, seconds)
+            return
+
+        self.sliderChangedPixmap = Pixmap
+        self.sliderReplay = (context["base"], functools.partial(self.replaySliderRender, state=context["state"], mask=context["mask"]), Pixmap, context["state"])
+        if context["table"] is not None:
+            self.DeriveNextHistogram(context["base"], context["table"])
+        self.sliderChangeSignal.emit()
+        self.renderScheduler.presented(generation, seconds)
+
+    @QtCore.pyqtSlot(int, str)
+    def onSliderRenderFailed(self, generation, message):
+        # The image on screen stays, the scheduler moves on once the job finished
+        self.statusBar.showMessage("Render failed: " + message, 3000)
+
+    def finishSliderSession(self):
+        # Called when the Adjust window closes. Records the full resolution render of the
+        # final slider state, never the proxy on screen; renders still running are dropped.
+        self.slidersOpen = False
+        self.isDraggingSlider = False
+        self.sliderPreviewRendered = False
+        self.renderScheduler.cancel()
+
+        replay = self.sliderReplay
+        self.sliderReplay = None
+        state = self.getSliderState()
+        base = self.image_viewer.getCurrentLayerLatestImage()
+        if base is not None:
+            if self.adjustmentEngine.isIdentity(state):
+                # Nothing changed, the view goes back to the image in the history
+                self.image_viewer.setImage(base.pixmap(), False, historyImage=base)
+            else:
+                if replay is None or replay[3] != state or self.image_viewer.isShowingPreview():
+                    # The latest state is not on screen at full resolution yet, render it here
+                    function = functools.partial(self.replaySliderRender, state=state, mask=self.image_viewer.selectionMask())
+                    replay = (base, function, ArrayToQPixmap(function(base.buffer())), state)
+                # The history keeps the slider state and renders it again once the result is cold
+                base, function, pixmap, _ = replay
+                self.image_viewer.setImage(pixmap, True, "Sliders", base=base, replay=function)
+
+        self.sliderSource = None
+        self.sliderSourceKey = None
+        self.proxyPreview.clear()
+        self.adjustmentEngine.stageCache.clear()
+
+    def replaySliderRender(self, buffer, state, mask):
+        # Renders a slider state again onto a writable BGRA copy of its source, for the history
+        if mask is None:
+            return self.adjustmentEngine.render(buffer, state)
+        region = self.adjustmentEngine.render(defaultScratchDisk.copy(mask.crop(buffer)), state)
+        return mask.composite(buffer, region, out=buffer)
+
+    def onSliderLatency(self, latency, renderSeconds):
+        # Latest render and the average of the recent ones
+        averageRender = self.renderScheduler.averageRenderTime()
+        averageLatency = self.renderScheduler.averageLatency()
+        self.statusBar.showMessage("Render " + str(int(renderSeconds * 1000)) + " ms (average " + str(int(averageRender * 1000)) + " ms), " +
+                                   "slider to pixel " + str(int(latency * 1000)) + " ms (average " + str(int(averageLatency * 1000)) + " ms)", 3000)
 
     def RemoveRenderedCursor(self):
         # The cursor overlay is being rendered in the view
@@ -672,6 +801,8 @@ class Gui(QtWidgets.QMainWindow):
                 self.HistogramLayout = QtWidgets.QVBoxLayout(self.HistogramContent)
                 self.HistogramLayout.addWidget(self.ImageHistogramPlot)
                 self.HistogramContent.setWindowFlags(Qt.WindowType.WindowStaysOnTopHint)
+            # Count every pixel once on demand, image changes only count a sample
+            self.RefreshHistogramPlot(exact=True)
             self.ImageHistogramPlot.show()
             self.HistogramContent.show()
             # Create a local event loop for this widget
@@ -688,9 +819,8 @@ class Gui(QtWidgets.QMainWindow):
         if checked:
             self.InitTool()
             pixmap = self.getCurrentLayerLatestPixmap()
-            pil = self.QPixmapToImage(pixmap)
-            pil = pil.rotate(90, expand=True)
-            updatedPixmap = self.ImageToQPixmap(pil)
+            buffer = QPixmapToArray(pixmap, writable=False)
+            updatedPixmap = ArrayToQPixmap(defaultScratchDisk.copy(np.rot90(buffer)))
             self.image_viewer.setImage(updatedPixmap, True, "Rotate Left", "Tool", None, None)
         self.RotateToolButton.setChecked(False)
 
@@ -699,9 +829,8 @@ class Gui(QtWidgets.QMainWindow):
         if checked:
             self.InitTool()
             pixmap = self.getCurrentLayerLatestPixmap()
-            pil = self.QPixmapToImage(pixmap)
-            pil = pil.transpose(Image.FLIP_LEFT_RIGHT)
-            updatedPixmap = self.ImageToQPixmap(pil)
+            buffer = QPixmapToArray(pixmap, writable=False)
+            updatedPixmap = ArrayToQPixmap(defaultScratchDisk.copy(buffer[:, ::-1]))
             self.image_viewer.setImage(updatedPixmap, True, "Flip Left-Right", "Tool", None, None)
         self.FlipLeftRightToolButton.setChecked(False)
 
@@ -709,19 +838,22 @@ class Gui(QtWidgets.QMainWindow):
         if checked:
             self.InitTool()
             pixmap = self.getCurrentLayerLatestPixmap()
-            pil = self.QPixmapToImage(pixmap)
-            pil = pil.transpose(Image.FLIP_TOP_BOTTOM)
-            updatedPixmap = self.ImageToQPixmap(pil)
+            buffer = QPixmapToArray(pixmap, writable=False)
+            updatedPixmap = ArrayToQPixmap(defaultScratchDisk.copy(buffer[::-1]))
             self.image_viewer.setImage(updatedPixmap, True, "Flip Top-Bottom", "Tool", None, None)
         self.FlipTopBottomToolButton.setChecked(False)
 
     
     @QtCore.pyqtSlot()
-    def onWhiteBalanceCompleted(self, tool):
+    def onWhiteBalanceCompleted(self, tool, source=None, mask=None):
         output = tool.output
         if output is not None:
+            if mask is not None:
+                # Only the selection was corrected
+                output = mask.composite(source, output)
+
             # Save new pixmap
-            updatedPixmap = self.ImageToQPixmap(output)
+            updatedPixmap = ArrayToQPixmap(output)
             self.image_viewer.setImage(updatedPixmap, True, "White Balance")
 
         self.WhiteBalanceToolButton.setChecked(False)
@@ -732,15 +864,22 @@ class Gui(QtWidgets.QMainWindow):
         if checked:
             self.InitTool()
             currentPixmap = self.getCurrentLayerLatestPixmap()
-            image = self.QPixmapToImage(currentPixmap)
+            source = QPixmapToArray(currentPixmap, writable=False)
+
+            # With a selection only its bounding box is corrected
+            mask = self.image_viewer.selectionMask()
+            image = source if mask is None else mask.crop(source)
 
             from QToolWhiteBalance import QToolWhiteBalance
-            widget = QToolWhiteBalance(None, image, self.onWhiteBalanceCompleted)
+            onCompleted = functools.partial(self.onWhiteBalanceCompleted, source=source, mask=mask)
+            widget = QToolWhiteBalance(None, image, onCompleted)
             widget.show()
 
     def OnSlidersToolButton(self, checked):
         if checked:
             self.InitTool()
+            self.sliderReplay = None
+            self.slidersOpen = True
             class SlidersScrollWidget(QtWidgets.QScrollArea):
                 def __init__(self, parent, mainWindow):
                     QtWidgets.QScrollArea.__init__(self, parent)
@@ -752,8 +891,8 @@ class Gui(QtWidgets.QMainWindow):
                     self.destroyed.emit()
                     event.accept()
                     self.closed = True
+                    self.mainWindow.finishSliderSession()
                     self.mainWindow.SlidersToolButton.setChecked(False)
-                    self.mainWindow.image_viewer.setImage(self.mainWindow.image_viewer.pixmap(), True, "Sliders")
 
             self.slidersScroll = SlidersScrollWidget(None, self)
             self.slidersContent = QtWidgets.QWidget()
@@ -792,6 +931,12 @@ class Gui(QtWidgets.QMainWindow):
 
             self.AddGaussianBlurSlider(self.slidersLayout)
 
+            # Render a proxy while dragging, full resolution on release
+            for slider in [self.RedColorSlider, self.GreenColorSlider, self.BlueColorSlider, self.ColorSlider,
+                           self.BrightnessSlider, self.ContrastSlider, self.SharpnessSlider, self.GaussianBlurSlider]:
+                slider.sliderPressed.connect(self.OnSliderPressed)
+                slider.sliderReleased.connect(self.OnSliderReleased)
+
             self.slidersScroll.setStyleSheet('''
                 background-color: rgb(44, 44, 44);
             ''')
@@ -842,14 +987,23 @@ class Gui(QtWidgets.QMainWindow):
                     event.accept()
                     self.closed = True
                     self.mainWindow.InstagramFiltersToolButton.setChecked(False)
-                    self.mainWindow.image_viewer.setImage(self.mainWindow.image_viewer.pixmap(), True, "Instagram Filters")
+                    tool = self.widget()
+                    if tool.pixmap is None:
+                        self.mainWindow.image_viewer.setImage(self.mainWindow.image_viewer.pixmap(), True, "Instagram Filters")
+                    else:
+                        # The history keeps the filter name and applies it again once the result is cold
+                        self.mainWindow.image_viewer.setImage(tool.pixmap, True, "Instagram Filters", base=tool.base, replay=tool.replay())
 
             self.EnableTool("instagram_filters") if checked else self.DisableTool("instagram_filters")
             currentPixmap = self.getCurrentLayerLatestPixmap()
-            image = self.QPixmapToImage(currentPixmap)
+            source = QPixmapToArray(currentPixmap, writable=False)
+
+            # With a selection the filters only run on its bounding box
+            mask = self.image_viewer.selectionMask()
+            image = ArrayToImage(source if mask is None else mask.crop(source))
 
             from QToolInstagramFilters import QToolInstagramFilters
-            tool = QToolInstagramFilters(self, image)
+            tool = QToolInstagramFilters(self, image, source, mask, self.image_viewer.getCurrentLayerLatestImage())
             self.filtersDock = QInstagramToolDockWidget(None, self)
             self.filtersDock.setWidget(tool)
             self.addDockWidget(QtCore.Qt.DockWidgetArea.BottomDockWidgetArea, self.filtersDock)
@@ -907,57 +1061,48 @@ class Gui(QtWidgets.QMainWindow):
                 getattr(self.image_viewer, value["destructor"])()
 
     def updateHistogram(self):
-        # Update Histogram
-
-        # Compute image histogram
-        img = self.QPixmapToImage(self.getCurrentLayerLatestPixmap())
-        r, g, b, a = img.split()
-        r_histogram = r.histogram()
-        g_histogram = g.histogram()
-        b_histogram = b.histogram()
-        
-        # ITU-R 601-2 luma transform:
-        luma_histogram = [sum(x) for x in zip([item * float(299/1000) for item in r_histogram],
-                                              [item * float(587/1000) for item in g_histogram],
-                                              [item * float(114/1000) for item in b_histogram])]
-
-        # Create histogram plot
-        x = list(range(len(r_histogram)))
-        self.ImageHistogramPlot.removeItem(self.ImageHistogramGraphRed)
-        self.ImageHistogramPlot.removeItem(self.ImageHistogramGraphGreen)
-        self.ImageHistogramPlot.removeItem(self.ImageHistogramGraphBlue)
-        self.ImageHistogramPlot.removeItem(self.ImageHistogramGraphLuma)
-        self.ImageHistogramGraphRed = pg.PlotCurveItem(x = x, y = r_histogram, fillLevel=2, width = 1.0, brush=(255,0,0,80))
-        self.ImageHistogramGraphGreen = pg.PlotCurveItem(x = x, y = g_histogram, fillLevel=2, width = 1.0, brush=(0,255,0,80))
-        self.ImageHistogramGraphBlue = pg.PlotCurveItem(x = x, y = b_histogram, fillLevel=2, width = 1.0, brush=(0,0,255,80))
-        self.ImageHistogramGraphLuma = pg.PlotCurveItem(x = x, y = luma_histogram, fillLevel=2, width = 1.0, brush=(255,255,255,80))
-        self.ImageHistogramPlot.addItem(self.ImageHistogramGraphRed)
-        self.ImageHistogramPlot.addItem(self.ImageHistogramGraphGreen)
-        self.ImageHistogramPlot.addItem(self.ImageHistogramGraphBlue)
-        self.ImageHistogramPlot.addItem(self.ImageHistogramGraphLuma)
+        # Update Histogram, every pixel counted, once it is shown
+        self.histogramStale = True
+        if self.ImageHistogramPlot.isVisible():
+            self.RefreshHistogramPlot(exact=True)
 
     def OnOpen(self):
         # Load an image file to be displayed (will popup a file dialog).
-
+        # It is decoded in the background, OnImageOpened() follows once it is in
         self.image_viewer.open()
+
+    def setEditingEnabled(self, enabled):
+        # Tools, save and undo work on the history, which has no image while one opens
+        for button in self.ToolButtons:
+            button.setEnabled(enabled)
+        for shortcut in [self.SaveShortcut, self.SaveAsShortcut, self.UndoShortcut]:
+            shortcut.setEnabled(enabled)
+
+    def OnImageOpening(self):
+        self.setEditingEnabled(False)
+
+    def OnImageOpenFailed(self, filepath):
+        self.statusBar.showMessage("Cannot open " + os.path.basename(filepath))
+        self.setEditingEnabled(self.image_viewer.getCurrentLayerLatestImage() is not None)
+
+    def OnImageOpened(self, firstPixelSeconds, seconds):
         if self.image_viewer._current_filename != None:
             size = self.image_viewer.currentPixmapSize()
             if size:
                 w, h = size.width(), size.height()
-                self.statusBar.showMessage(str(w) + "x" + str(h))
+                self.statusBar.showMessage(str(w) + "x" + str(h) + ", first pixel " + str(int(firstPixelSeconds * 1000)) + " ms, full image " + str(int(seconds * 1000)) + " ms")
             self.InitTool()
             self.DisableAllTools()
             filename = self.image_viewer._current_filename
             filename = os.path.basename(filename)
             # self.image_viewer.OriginalImage = self.image_viewer.pixmap()
             self.updateHistogram()
-            for button in self.ToolButtons:
-                button.setEnabled(True)
+            self.setEditingEnabled(True)
 
     
     def OnSave(self):
-        if self.image_viewer._current_filename.lower().endswith(".nef"):
-            # Cannot save pixmap as .NEF (yet)
+        if isRaw(self.image_viewer._current_filename):
+            # Cannot save pixmap as RAW
             # so open SaveAs menu to export as PNG instead
             self.OnSaveAs()
         else:
@@ -0,0 +1,43 @@
+""" test_BlurEngine.py: Checks every blur quality against ImageFilter.GaussianBlur """
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter
+
+from BlurEngine import BALANCED, EXACT, FAST, gaussianBlur
+
+RADII = (0.5, 2, 5, 10, 40)
+
+
+@pytest.fixture(scope="module")
+def photo():
+    """ Smooth gradients with hard edges and fine noise on top, a stand-in for a photograph """
+    rng = np.random.default_rng(0)
+    photo = cv2.resize(rng.integers(0, 256, (12, 16, 4), dtype=np.uint8), (1600, 1200), interpolation=cv2.INTER_CUBIC)
+    photo[300:900, 400:1200, :3] //= 2
+    return cv2.add(photo, rng.integers(0, 24, photo.shape, dtype=np.uint8))
+
+
+def error(buffer, radius, quality):
+    reference = np.asarray(Image.fromarray(buffer, "RGBA").filter(ImageFilter.GaussianBlur(radius)))
+    return np.abs(gaussianBlur(buffer, radius, quality).astype(np.int16) - reference)
+
+
+@pytest.mark.parametrize("radius", RADII)
+def test_exact(photo, radius):
+    assert error(photo, radius, EXACT).max() == 0
+
+
+@pytest.mark.parametrize("radius", RADII)
+def test_exact_noise(radius):
+    noise = np.random.default_rng(1).integers(0, 256, (300, 400, 4), dtype=np.uint8)
+    assert error(noise, radius, EXACT).max() == 0
+
+
+@pytest.mark.parametrize("quality", (BALANCED, FAST))
+@pytest.mark.parametrize("radius", RADII)
+def test_approximate(photo, radius, quality):
+    difference = error(photo, radius, quality)
+    assert difference.max() <= 4
+    assert difference.mean() < 1
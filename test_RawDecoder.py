@@ -0,0 +1,80 @@
+""" test_RawDecoder.py: Checks the RAW previews against a stand-in for rawpy """
+
+import types
+
+import numpy as np
+import pytest
+
+import ImageLoader
+import RawDecoder
+
+
+class LibRawError(Exception):
+    pass
+
+
+class FakeRaw:
+    """ A 4000 x 3000 sensor mounted upright, without an embedded image """
+
+    def __init__(self):
+        self.sizes = types.SimpleNamespace(width=4000, height=3000, flip=0)
+        self.postprocessed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_thumb(self):
+        raise LibRawError("no thumbnail")
+
+    def postprocess(self, half_size=False, **parameters):
+        self.postprocessed.append(dict(parameters, half_size=half_size))
+        scale = 2 if half_size else 1
+        pixels = np.zeros((3000 // scale, 4000 // scale, 3), dtype=np.uint8)
+        pixels[..., 0] = 200
+        return pixels
+
+
+@pytest.fixture
+def raw(monkeypatch, tmp_path):
+    raw = FakeRaw()
+    rawpy = types.SimpleNamespace(imread=lambda filepath: raw, LibRawError=LibRawError,
+                                  ThumbFormat=types.SimpleNamespace(JPEG="jpeg", BITMAP="bitmap"))
+    monkeypatch.setattr(RawDecoder, "rawpy", rawpy)
+    monkeypatch.setattr(RawDecoder, "defaultRawCache", RawDecoder.RawCache(str(tmp_path / "cache")))
+    return raw
+
+
+@pytest.fixture
+def filepath(tmp_path):
+    path = tmp_path / "photo.nef"
+    path.write_bytes(b"raw")
+    return str(path)
+
+
+def test_no_embedded_preview(raw, filepath):
+    assert ImageLoader.readPreview(filepath, 800, 600) is None
+    assert raw.postprocessed == []
+
+
+def test_half_size_preview(raw, filepath):
+    image, size = ImageLoader.readWorkerPreview(filepath)
+    assert (image.width(), image.height()) == (2000, 1500)
+    assert (size.width(), size.height()) == (4000, 3000)
+    assert image.pixelColor(0, 0).red() == 200
+    assert raw.postprocessed == [dict(RawDecoder.DECODE_PARAMETERS, half_size=True)]
+
+
+def test_no_preview_once_cached(raw, filepath):
+    buffer = RawDecoder.decodeRaw(filepath)
+    assert buffer.shape == (3000, 4000, 4)
+    assert ImageLoader.readWorkerPreview(filepath) is None
+    assert len(raw.postprocessed) == 1
+
+
+def test_no_preview_of_other_files(raw, tmp_path):
+    path = tmp_path / "photo.png"
+    path.write_bytes(b"png")
+    assert ImageLoader.readWorkerPreview(str(path)) is None